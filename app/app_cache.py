@@ -0,0 +1,138 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import pytz
+
+RENDER_CACHE_DIR = 'cache/render'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+# готовые картинки и PDF по ключу из входных данных: в памяти держатся последние по обращению,
+# на диске — всё, что влезает в лимит; при переполнении удаляются давно не запрошенные
+class RenderCache:
+
+    def __init__(self, cache_dir: str = RENDER_CACHE_DIR,
+                 memory_limit: int = 64 * 1024 * 1024, disk_limit: int = 1024 * 1024 * 1024) -> None:
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.disk_size = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def is_key(key: str) -> bool:
+        # ключ становится частью пути к файлу, поэтому снаружи принимаются только такие, какие выдаёт make_key
+        return len(key) == 64 and all(c in '0123456789abcdef' for c in key)
+
+    def get(self, key: str):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                return data
+
+        file_name = self._get_file_name(key)
+        try:
+            with open(file_name, 'rb') as f:
+                data = f.read()
+            os.utime(file_name)
+        except FileNotFoundError:
+            return None
+        self._put_to_memory(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        self._put_to_memory(key, data)
+
+        file_name = self._get_file_name(key)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(file_name), delete=False) as f:
+            f.write(data)
+        # при повторной записи того же ключа старый файл заменяется, и его размер из суммы вычитается
+        try:
+            old_size = os.path.getsize(file_name)
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(f.name, file_name)
+
+        with self.lock:
+            if self.disk_size is None:
+                self.disk_size = sum(size for _, _, size in self._list_files())
+            else:
+                self.disk_size += len(data) - old_size
+            if self.disk_size > self.disk_limit:
+                self._evict_from_disk()
+
+    def _put_to_memory(self, key: str, data: bytes) -> None:
+        with self.lock:
+            if key in self.memory:
+                return
+            self.memory[key] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.memory_limit and len(self.memory) > 1:
+                _, old_data = self.memory.popitem(last=False)
+                self.memory_size -= len(old_data)
+
+    def _get_file_name(self, key: str) -> str:
+        return f'{self.cache_dir}/{key[:2]}/{key}'
+
+    def _list_files(self):
+        files = []
+        for dir_path, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        return files
+
+    def _evict_from_disk(self) -> None:
+        # освобождаем с запасом, чтобы не обходить каталог на каждой записи
+        files = sorted(self._list_files())
+        self.disk_size = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if self.disk_size <= self.disk_limit * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.disk_size -= size
+
+
+render_cache = RenderCache()
+
+
+def normalize_fio(fio: str) -> str:
+    # на картинках имя пишется заглавными, поэтому регистр и лишние пробелы на результат не влияют
+    return ' '.join(fio.split()).upper()
+
+
+def get_cur_day() -> str:
+    # точка жизни на космограмме сдвигается раз в сутки, поэтому от текущего дня зависит картинка
+    return datetime.now(pytz.timezone("Europe/Moscow")).strftime('%Y-%m-%d')
+
+
+def render_cached(key: str, render_foo) -> bytes:
+    # render_foo(out) рисует в файлоподобный объект; при повторном запросе результат берётся из кэша без отрисовки
+    data = render_cache.get(key)
+    if data is None:
+        out = io.BytesIO()
+        render_foo(out)
+        data = out.getvalue()
+        render_cache.put(key, data)
+    return data
@@ -1,23 +1,25 @@
-import base64
+import io
+import itertools
 import math
-import os
-import tempfile
+
 from flatlib import const
 
 import cairo
 
 from datetime import datetime, timedelta
 
+from app.app_cache import render_cache, render_cached, get_cur_day, normalize_fio
 from ext.sf_geocoder import SFGeocoder
 from model.sf_flatlib import FlatlibBuilder
-from model.sf_transit import find_nearest_connections
+from model.sf_transit import find_nearest_connections, TRANSIT_PLANETS
 from view.planet_label import PlanetLabelDrawer
 from view.sf_cosmogram import DefaultCosmogramDrawer
 from view.sf_printer import TransitPrinter
 
 
 def generate_full_transit(geocoder, name: str, birthday_time: datetime, city: str, dt: datetime, cur_city: str,
-                          show_source: bool, show_source_to_transit: bool, show_transit: bool) -> str:
+                          show_source: bool, show_source_to_transit: bool, show_transit: bool) -> (str, bytes):
+    name = normalize_fio(name)
     birthday_as_str = birthday_time.strftime('%Y-%m-%d %H:%M')
     dt_as_str = dt.strftime('%Y-%m-%d %H:%M')
 
@@ -26,32 +28,32 @@ def generate_full_transit(geocoder, name: str, birthday_time: datetime, city: st
 
     dt_birthday = datetime.strptime(f'{birthday_as_str} {geo_res.utc_offset}', '%Y-%m-%d %H:%M %z')
     dt_transit = datetime.strptime(f'{dt_as_str} {geo_res_now.utc_offset}', '%Y-%m-%d %H:%M %z')
-    builder = FlatlibBuilder()
-    cosmo1 = builder.build_cosmogram(dt_birthday, lat=geo_res.lat, lon=geo_res.lon,
-                                     planets_to_exclude=[const.PARS_FORTUNA])
 
-    new_file, filename = tempfile.mkstemp(suffix='.pdf', prefix='transit_')
-    print(f'Создан временный файл для вывода космограммы: {filename}')
+    def render(out):
+        builder = FlatlibBuilder()
+        cosmo1 = builder.build_cosmogram(dt_birthday, lat=geo_res.lat, lon=geo_res.lon,
+                                         planets_to_exclude=[const.PARS_FORTUNA])
 
-    printer = TransitPrinter()
-    surface_pdf = cairo.PDFSurface(
-        filename, printer.width + 2 * printer.border_offset, printer.height + 2 * printer.border_offset)
-    cr = cairo.Context(surface_pdf)
-    cr.scale(200, 200)
+        printer = TransitPrinter()
+        surface_pdf = cairo.PDFSurface(
+            out, printer.width + 2 * printer.border_offset, printer.height + 2 * printer.border_offset)
+        cr = cairo.Context(surface_pdf)
+        cr.scale(200, 200)
 
-    cosmo2 = builder.build_cosmogram(dt_transit, lat=geo_res_now.lat, lon=geo_res_now.lon,
-                                     planets_to_exclude=[const.PARS_FORTUNA])
+        cosmo2 = builder.build_transit_cosmogram(dt_transit)
 
-    printer.print_info(name, geo_res.address, cosmo1, cosmo2, surface_pdf,
-                       show_source, show_source_to_transit, show_transit)
-    surface_pdf.finish()
-    os.close(new_file)
+        printer.print_info(name, geo_res.address, cosmo1, cosmo2, surface_pdf,
+                           show_source, show_source_to_transit, show_transit)
+        surface_pdf.finish()
 
-    return filename
+    key = render_cache.make_key('full_transit', name, birthday_as_str, geo_res.address, geo_res.lat, geo_res.lon,
+                                geo_res.utc_offset, dt_as_str, geo_res_now.address, geo_res_now.utc_offset,
+                                show_source, show_source_to_transit, show_transit, get_cur_day())
+    return key, render_cached(key, render)
 
 
 def generate_transit(geocoder: SFGeocoder, birthday_time: datetime, city: str, dt: datetime, cur_city: str,
-                     show_source: bool, show_source_to_transit: bool, show_transit: bool) -> str:
+                     show_source: bool, show_source_to_transit: bool, show_transit: bool) -> (str, bytes):
     birthday_as_str = birthday_time.strftime('%Y-%m-%d %H:%M')
     dt_as_str = dt.strftime('%Y-%m-%d %H:%M')
 
@@ -61,27 +63,27 @@ def generate_transit(geocoder: SFGeocoder, birthday_time: datetime, city: str, d
     dt_birthday = datetime.strptime(f'{birthday_as_str} {geo_res.utc_offset}', '%Y-%m-%d %H:%M %z')
     dt_transit = datetime.strptime(f'{dt_as_str} {geo_res_now.utc_offset}', '%Y-%m-%d %H:%M %z')
 
-    builder = FlatlibBuilder()
-    cosmo1 = builder.build_cosmogram(dt_birthday, lat=geo_res.lat, lon=geo_res.lon,
-                                     planets_to_exclude=[const.PARS_FORTUNA])
+    def render(out):
+        builder = FlatlibBuilder()
+        cosmo1 = builder.build_cosmogram(dt_birthday, lat=geo_res.lat, lon=geo_res.lon,
+                                         planets_to_exclude=[const.PARS_FORTUNA])
 
-    new_file, filename = tempfile.mkstemp(suffix='.png', prefix='transit_')
-    print(f'Создан временный файл для вывода космограммы: {filename}')
-    w, h = 2000, 2000
-    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
-    cr = cairo.Context(surface)
-    cr.scale(w, h)
+        w, h = 2000, 2000
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        cr = cairo.Context(surface)
+        cr.scale(w, h)
 
-    cosmo2 = builder.build_cosmogram(dt_transit, lat=geo_res_now.lat, lon=geo_res_now.lon,
-                                     planets_to_exclude=[const.PARS_FORTUNA])
+        cosmo2 = builder.build_transit_cosmogram(dt_transit)
 
-    drawer = DefaultCosmogramDrawer(planet_ruler_place='in_sign', life_years=0)
-    drawer.draw_transit(cosmo1, cosmo2, cr, show_source, show_source_to_transit, show_transit)
-    surface.write_to_png(filename)
-    surface.finish()
-    os.close(new_file)
+        drawer = DefaultCosmogramDrawer(planet_ruler_place='in_sign', life_years=0)
+        drawer.draw_transit(cosmo1, cosmo2, cr, show_source, show_source_to_transit, show_transit)
+        surface.write_to_png(out)
+        surface.finish()
 
-    return filename
+    key = render_cache.make_key('transit', birthday_as_str, geo_res.address, geo_res.lat, geo_res.lon,
+                                geo_res.utc_offset, dt_as_str, geo_res_now.address, geo_res_now.utc_offset,
+                                show_source, show_source_to_transit, show_transit, get_cur_day())
+    return key, render_cached(key, render)
 
 
 def get_nearest_transit_connections(geocoder: SFGeocoder, birthday_time: datetime, city: str,
@@ -102,15 +104,39 @@ def get_nearest_transit_connections(geocoder: SFGeocoder, birthday_time: datetim
     res = find_nearest_connections(cosmo1, (dt_transit + timedelta(days=1)).replace(hour=0, minute=1))
     view = {}
     for planet1, (planet2, _, movement1) in res.items():
-        b64 = get_connection_pic(planet1, planet2,
-                                 movement1 == const.RETROGRADE,
-                                 cosmo1.get_planet_info(planet2).movement == const.RETROGRADE)
-        view[planet1] = b64
+        view[planet1] = get_connection_pic_url(planet1, planet2,
+                                               movement1 == const.RETROGRADE,
+                                               cosmo1.get_planet_info(planet2).movement == const.RETROGRADE)
     return res, view
 
 
-def get_connection_pic(planet1: str, planet2: str, is_retro1: bool, is_retro2: bool) -> str:
-    new_file, filename = tempfile.mkstemp(suffix='.png', prefix='transit_')
+# значков соединений всего 14 × 14 × 4, поэтому каждый рисуется один раз на процесс и дальше отдаётся из памяти
+_connection_pics = {}
+
+
+def get_connection_pic_url(planet1: str, planet2: str, is_retro1: bool, is_retro2: bool) -> str:
+    return f'/connection/{TRANSIT_PLANETS.index(planet1)}-{TRANSIT_PLANETS.index(planet2)}-' \
+           f'{int(is_retro1)}-{int(is_retro2)}.png'
+
+
+def get_connection_pic(planet1: str, planet2: str, is_retro1: bool, is_retro2: bool) -> bytes:
+    key = (planet1, planet2, is_retro1, is_retro2)
+    pic = _connection_pics.get(key)
+    if pic is None:
+        out = io.BytesIO()
+        draw_connection_pic(planet1, planet2, is_retro1, is_retro2, out)
+        pic = out.getvalue()
+        _connection_pics[key] = pic
+    return pic
+
+
+def prepare_connection_pics() -> None:
+    for planet1, planet2 in itertools.product(TRANSIT_PLANETS, TRANSIT_PLANETS):
+        for is_retro1, is_retro2 in itertools.product([False, True], [False, True]):
+            get_connection_pic(planet1, planet2, is_retro1, is_retro2)
+
+
+def draw_connection_pic(planet1: str, planet2: str, is_retro1: bool, is_retro2: bool, out) -> None:
     h = 100
     w = h * 3
     surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
@@ -159,12 +185,5 @@ def get_connection_pic(planet1: str, planet2: str, is_retro1: bool, is_retro2: b
     drawer.draw_planet(planet2, cr)
     cr.restore()
 
-    surface.write_to_png(filename)
+    surface.write_to_png(out)
     surface.finish()
-    os.close(new_file)
-
-    with open(filename, "rb") as img_file:
-        b64_string = base64.b64encode(img_file.read()).decode('utf-8')
-        os.remove(filename)
-
-        return b64_string
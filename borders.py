@@ -1,59 +1,183 @@
+import os
+import shutil
 import time
 
+from bisect import bisect_left
 from datetime import datetime, timedelta
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
 
-from model.sf_flatlib import FlatlibBuilder
+import numpy as np
+
+from model.sf_catalog import FormulaCatalog, CATALOG_DTYPE, formula_to_record, get_catalog_file_name
+from model.sf_ephemeris import dt_to_jd
+from model.sf_events import get_event_index, jd_to_minute, minute_to_dt, EVENTS_FILE
+from model.sf_flatlib import FlatlibBuilder, get_formula_state
 
 
 def iterate_borders(borders_file_name, formula_foo):
+    # если рядом с файлом границ есть каталог формул, формулы читаются из него без пересчёта карт
+    catalog_file_name = get_catalog_file_name(borders_file_name)
+    if os.path.exists(catalog_file_name):
+        for f in FormulaCatalog.load(catalog_file_name).iterate_formulas():
+            formula_foo(f.formula, f.from_dt, f.to_dt)
+        return
+
     builder = FlatlibBuilder()
+    for from_day, to_day in _read_intervals(borders_file_name):
+        formula = builder.build_formula_by_index(to_day)
+        formula_foo(formula, from_day, to_day)
+
+
+def _read_intervals(borders_file_name):
+    intervals = []
     with open(borders_file_name) as f:
         prev_day = None
         for line in f:
             cur_day = datetime.strptime(line.strip(), '%Y-%m-%d %H:%M')
             if prev_day is None:
                 prev_day = cur_day
-
-            formula = builder.build_formula(cur_day)
-            formula_foo(formula, prev_day, cur_day)
+            intervals.append((prev_day, cur_day))
             prev_day = cur_day + timedelta(minutes=1)
+    return intervals
+
+
+def make_catalog(borders_file_name, processes=None, batch_size=1000):
+    # те же формулы, что строит iterate_borders, один раз сохраняются в бинарный каталог рядом с файлом границ
+    intervals = _read_intervals(borders_file_name)
+    batches = [intervals[i:i + batch_size] for i in range(0, len(intervals), batch_size)]
+    records = []
+    with Pool(processes) as pool:
+        for batch_records in pool.imap(_make_catalog_records, batches):
+            records.extend(batch_records)
+    catalog = FormulaCatalog(np.array(records, dtype=CATALOG_DTYPE))
+    catalog.save(get_catalog_file_name(borders_file_name))
+    return catalog
 
 
-def make_borders(out_file, from_date='1900/01/01', to_date='2030/12/31'):
+def _make_catalog_records(intervals):
     builder = FlatlibBuilder()
-    cur_day = datetime.strptime(from_date, '%Y/%m/%d')
-    formula = builder.build_formula(cur_day)
-    last_formula_id = formula.get_id()
+    return [formula_to_record(builder.build_formula_by_index(to_day), from_day, to_day)
+            for from_day, to_day in intervals]
+
+
+def iterate_intervals(formula_foo, from_date='1300/01/01', to_date='2999/12/31'):
+    # то же, что iterate_borders, но границы формул берутся прямо из индекса событий, без файла с границами
+    builder = FlatlibBuilder()
+    index = get_event_index()
+    if index is None:
+        raise ValueError(f'Не найден индекс событий {EVENTS_FILE}, сначала постройте его (model/sf_events.py).')
+    from_jd = dt_to_jd(datetime.strptime(from_date, '%Y/%m/%d'))
+    to_jd = dt_to_jd(datetime.strptime(to_date, '%Y/%m/%d'))
+    for start_jd, end_jd, _, _ in index.iterate_intervals(from_jd, to_jd):
+        if start_jd == index.start_jd:
+            continue
+        from_day = minute_to_dt(jd_to_minute(start_jd))
+        to_day = minute_to_dt(jd_to_minute(end_jd) - 1)
+        formula_foo(builder.build_formula_by_index(to_day), from_day, to_day)
+
+
+# сколько считает каждый кусок после своей границы, чтобы встретить ту же смену формулы, что и следующий кусок
+BORDERS_OVERLAP = timedelta(days=7)
+
+
+def make_borders(out_file, from_date='1900/01/01', to_date='2030/12/31', chunk_years=10, processes=None):
+    # диапазон режется на куски по годам, куски считаются параллельно и сохраняются по мере готовности,
+    # так что после падения посчитанные куски не пересчитываются
+    chunks = _split_to_chunks(from_date, to_date, chunk_years)
+    chunks_dir = out_file + '.chunks'
+    Path(chunks_dir).mkdir(parents=True, exist_ok=True)
+
+    chunks_to_make = [chunk for chunk in chunks if not os.path.exists(_get_chunk_file_name(chunks_dir, chunk))]
+    print(f'Кусков всего {len(chunks)}, осталось посчитать {len(chunks_to_make)}.')
+    with Pool(processes) as pool:
+        foo = partial(_make_chunk_borders, chunks_dir=chunks_dir, to_date=to_date)
+        for chunk_start, chunk_end in pool.imap_unordered(foo, chunks_to_make):
+            print(f'Посчитан кусок {chunk_start.strftime("%Y/%m/%d")} – {chunk_end.strftime("%Y/%m/%d")}')
+
+    borders = []
+    for chunk in chunks:
+        with open(_get_chunk_file_name(chunks_dir, chunk)) as f:
+            chunk_borders = [line.strip() for line in f]
+        borders = _join_borders(borders, chunk_borders)
+
     with open(out_file, 'w') as f:
-        f.write(cur_day.strftime("%Y-%m-%d %H:%M"))
+        f.write(chunks[0][0].strftime("%Y-%m-%d %H:%M"))
         f.write('\n')
-        f.flush()
-        __iterate(f, last_formula_id, cur_day, to_date, step_in_minutes=1440)
+        for border in borders:
+            f.write(border)
+            f.write('\n')
+    shutil.rmtree(chunks_dir)
 
+    make_catalog(out_file, processes)
 
-def __iterate(f, last_formula_id, last_formula_date, to_date, step_in_minutes):
-    builder = FlatlibBuilder()
+
+def _split_to_chunks(from_date, to_date, chunk_years):
+    chunks = []
+    chunk_start = datetime.strptime(from_date, '%Y/%m/%d')
+    last_date = datetime.strptime(to_date, '%Y/%m/%d')
+    while chunk_start < last_date:
+        chunk_end = min(datetime(chunk_start.year + chunk_years, 1, 1), last_date)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+    return chunks
+
+
+def _get_chunk_file_name(chunks_dir, chunk):
+    chunk_start, chunk_end = chunk
+    return f'{chunks_dir}/{chunk_start.strftime("%Y%m%d%H%M")}_{chunk_end.strftime("%Y%m%d%H%M")}.csv'
+
+
+def _make_chunk_borders(chunk, chunks_dir, to_date):
+    # тот же обход, что и при последовательном расчёте: шаг в сутки, а при смене формулы — деление шага пополам;
+    # вместо get_id() сравниваются знаки и ретроградность объектов, от которых он зависит
+    chunk_start, chunk_end = chunk
+    borders = []
+    last_formula_date = chunk_start
+    last_formula_state = get_formula_state(dt_to_jd(last_formula_date))
+    step_in_minutes = 1440
     while last_formula_date.strftime('%Y/%m/%d') != to_date:
         cur_date = last_formula_date + timedelta(minutes=step_in_minutes)
-        formula = builder.build_formula(cur_date)
-        formula_id = formula.get_id()
+        formula_state = get_formula_state(dt_to_jd(cur_date))
 
-        if formula_id == last_formula_id:
-            last_formula_id = formula_id
+        if formula_state == last_formula_state:
             last_formula_date = cur_date
             step_in_minutes = 1440
         else:
             if step_in_minutes == 1:
-                f.write(last_formula_date.strftime("%Y-%m-%d %H:%M"))
-                f.write('\n')
-                f.flush()
+                borders.append(last_formula_date.strftime("%Y-%m-%d %H:%M"))
+                if last_formula_date >= chunk_end + BORDERS_OVERLAP:
+                    break
 
-                last_formula_id = formula_id
+                last_formula_state = formula_state
                 last_formula_date = cur_date
                 step_in_minutes = 1440
             else:
                 step_in_minutes //= 2
 
+    file_name = _get_chunk_file_name(chunks_dir, chunk)
+    with open(file_name + '.tmp', 'w') as f:
+        for border in borders:
+            f.write(border)
+            f.write('\n')
+    os.replace(file_name + '.tmp', file_name)
+    return chunk
+
+
+def _join_borders(borders, chunk_borders):
+    if not borders:
+        return chunk_borders
+    # начало куска считалось не с той точки, что при последовательном обходе, поэтому его границы
+    # берутся только после первой границы, найденной обоими кусками — дальше обходы совпадают
+    for i, border in enumerate(chunk_borders):
+        j = bisect_left(borders, border)
+        if j < len(borders) and borders[j] == border:
+            del borders[j + 1:]
+            borders.extend(chunk_borders[i + 1:])
+            return borders
+    raise ValueError(f'Не удалось сшить границы формул на стыке кусков около {chunk_borders[0]}.')
+
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -1,4 +1,11 @@
+import csv
+import hashlib
+import os
+import sqlite3
+import threading
+import time
 from abc import abstractmethod
+from functools import lru_cache
 from typing import Dict, Any
 
 import requests
@@ -57,11 +64,117 @@ class YaGeocoder:
         return None
 
 
+GEOCODER_CACHE_FILE = 'cache/geocoder.sqlite'
+GEOCODER_CACHE_TTL = 180 * 24 * 60 * 60
+GEOCODER_CACHE_MAX_SIZE = 100000
+
+# частые запросы (крупные города), которые кладутся в кэш заранее и не устаревают;
+# строка файла — запрос, адрес, широта, долгота
+GEOCODER_CITIES_FILE = 'data/geocoder_cities.csv'
+
+
+def read_geocoder_results(file_name: str) -> {str: (str, (float, float))}:
+    with open(file_name, encoding='utf-8', newline='') as f:
+        return {query: (address, (float(lat), float(lon))) for query, address, lat, lon in csv.reader(f)}
+
+
+# заглушка вместо запросов к API: отвечает только на известные запросы, например, из файла городов
+class StubYaGeocoder:
+
+    def __init__(self, results: {str: (str, (float, float))}) -> None:
+        self.results = results
+
+    @staticmethod
+    def load(file_name: str = GEOCODER_CITIES_FILE):
+        return StubYaGeocoder(read_geocoder_results(file_name))
+
+    def geocode(self, address: str) -> (str, (float, float)):
+        return self.results.get(address)
+
+
+# результаты геокодера в SQLite: один файл на все процессы приложения, переживает перезапуски;
+# записи старше ttl секунд перезапрашиваются, при превышении max_size удаляются давно записанные
+class SqliteGeocoderCache:
+
+    def __init__(self, file_name: str = GEOCODER_CACHE_FILE,
+                 ttl: int = GEOCODER_CACHE_TTL, max_size: int = GEOCODER_CACHE_MAX_SIZE) -> None:
+        self.file_name = file_name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.local = threading.local()
+        dir_name = os.path.dirname(file_name)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS geocoder ('
+                               'query TEXT PRIMARY KEY, address TEXT, lat REAL, lon REAL, '
+                               'created REAL, pinned INTEGER DEFAULT 0)')
+            connection.execute('CREATE INDEX IF NOT EXISTS geocoder_created ON geocoder (pinned, created)')
+            connection.execute('CREATE TABLE IF NOT EXISTS geocoder_meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def _connect(self) -> sqlite3.Connection:
+        # соединение своё у каждого потока и процесса: после fork унаследованное соединение использовать нельзя
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.file_name, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get(self, query: str) -> (str, (float, float)):
+        row = self._connect().execute('SELECT address, lat, lon FROM geocoder '
+                                      'WHERE query = ? AND (pinned = 1 OR created >= ?)',
+                                      (query, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        address, lat, lon = row
+        return address, (lat, lon)
+
+    def put(self, query: str, res: (str, (float, float))) -> None:
+        address, (lat, lon) = res
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO geocoder (query, address, lat, lon, created, pinned) '
+                               'VALUES (?, ?, ?, ?, ?, 0)', (query, address, lat, lon, time.time()))
+            size, = connection.execute('SELECT COUNT(*) FROM geocoder WHERE pinned = 0').fetchone()
+            if size > self.max_size:
+                # удаляем с запасом, чтобы не чистить на каждой записи
+                connection.execute('DELETE FROM geocoder WHERE query IN (SELECT query FROM geocoder WHERE pinned = 0 '
+                                   'ORDER BY created LIMIT ?)', (size - int(self.max_size * 0.9),))
+
+    def preload(self, file_name: str = GEOCODER_CITIES_FILE) -> None:
+        # записываем города, только если файл поменялся с прошлой загрузки (версия — хэш его содержимого);
+        # города, которых в новом файле нет, перестают быть закреплёнными и со временем устаревают
+        with open(file_name, 'rb') as f:
+            version = hashlib.sha256(f.read()).hexdigest()
+        row = self._connect().execute("SELECT value FROM geocoder_meta WHERE key = 'cities'").fetchone()
+        if row is not None and row[0] == version:
+            return
+
+        results = read_geocoder_results(file_name)
+        with self._connect() as connection:
+            connection.execute('UPDATE geocoder SET pinned = 0 WHERE pinned = 1')
+            connection.executemany('INSERT OR REPLACE INTO geocoder (query, address, lat, lon, created, pinned) '
+                                   'VALUES (?, ?, ?, ?, ?, 1)',
+                                   [(query, address, lat, lon, time.time())
+                                    for query, (address, (lat, lon)) in results.items()])
+            connection.execute("INSERT OR REPLACE INTO geocoder_meta (key, value) VALUES ('cities', ?)", (version,))
+
+    def export(self, file_name: str, limit: int = 1000) -> None:
+        # самые частые запросы неизвестны, поэтому выгружаем закреплённые и самые свежие записи
+        rows = self._connect().execute('SELECT query, address, lat, lon FROM geocoder '
+                                       'ORDER BY pinned DESC, created DESC LIMIT ?', (limit,)).fetchall()
+        with open(file_name, 'w', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerows(rows)
+
+
 class CachedYaGeocoder:
     cache: {str, (str, (float, float))}
 
-    def __init__(self, token) -> None:
-        self.base_geocoder = YaGeocoder(token)
+    def __init__(self, token, storage: SqliteGeocoderCache = None, base_geocoder=None) -> None:
+        # storage — общий кэш на диске, self.cache — быстрый слой в памяти процесса поверх него
+        self.base_geocoder = YaGeocoder(token) if base_geocoder is None else base_geocoder
+        self.storage = storage
         self.cache = {}
 
     @staticmethod
@@ -74,13 +187,56 @@ class CachedYaGeocoder:
         if res:
             print(f'Возвращён закешированный результат геокодера на запрос «{address}»')
             return res
+        if self.storage is not None:
+            res = self.storage.get(address)
+            if res:
+                print(f'Возвращён сохранённый результат геокодера на запрос «{address}»')
+                self.cache[address] = res
+                return res
         res = self.base_geocoder.geocode(address)
         print(f'Возвращён новый результат геокодера на запрос «{address}»')
         if res:
             self.cache[address] = res
+            if self.storage is not None:
+                self.storage.put(address, res)
         return res
 
 
+# координаты округляются примерно до 10 м: точнее граница часового пояса всё равно не нужна
+TIMEZONE_COORD_DIGITS = 4
+
+_tz_finder = None
+_tz_finder_lock = threading.Lock()
+
+
+def get_timezone_finder() -> TimezoneFinder:
+    # TimezoneFinder при создании загружает полигоны поясов, поэтому он один на процесс;
+    # поиск в нём читает общие файлы через seek, так что обращаться к нему нужно под _tz_finder_lock
+    global _tz_finder
+    with _tz_finder_lock:
+        if _tz_finder is None:
+            _tz_finder = TimezoneFinder()
+    return _tz_finder
+
+
+@lru_cache(maxsize=100000)
+def _get_timezone_name(lat: float, lon: float) -> str:
+    tz_finder = get_timezone_finder()
+    with _tz_finder_lock:
+        return tz_finder.timezone_at(lng=lon, lat=lat)
+
+
+def get_timezone_name(lat: float, lon: float) -> str:
+    return _get_timezone_name(round(lat, TIMEZONE_COORD_DIGITS), round(lon, TIMEZONE_COORD_DIGITS))
+
+
+@lru_cache(maxsize=100000)
+def get_utc_offset(tz_name: str, dt_str: str) -> str:
+    tz = pytz.timezone(tz_name)
+    dt = tz.localize(datetime.strptime(dt_str, '%Y-%m-%d %H:%M'))
+    return dt.strftime('%z')
+
+
 class SFGeocoder:
 
     @abstractmethod
@@ -90,19 +246,21 @@ class SFGeocoder:
 
 class DefaultSFGeocoder(SFGeocoder):
 
-    def __init__(self, token) -> None:
-        self.ya_geocoder = CachedYaGeocoder(token)
+    def __init__(self, token, cache_file: str = GEOCODER_CACHE_FILE, base_geocoder=None) -> None:
+        # cache_file=None — только кэш в памяти процесса, как раньше
+        storage = None
+        if cache_file is not None:
+            storage = SqliteGeocoderCache(cache_file)
+            if os.path.exists(GEOCODER_CITIES_FILE):
+                storage.preload(GEOCODER_CITIES_FILE)
+        self.ya_geocoder = CachedYaGeocoder(token, storage, base_geocoder)
 
     def get_geo_position(self, src_address: str, dt_str: str) -> GeocoderResult:
 
         ya_geocoder_result = self.ya_geocoder.geocode(src_address)
         if ya_geocoder_result:
             address, (lat, lon) = ya_geocoder_result
-            tz_finder = TimezoneFinder()
-            tz_name = tz_finder.timezone_at(lng=lon, lat=lat)
-            tz = pytz.timezone(tz_name)
-            dt = tz.localize(datetime.strptime(dt_str, '%Y-%m-%d %H:%M'))
-            offset = dt.strftime('%z')
+            offset = get_utc_offset(get_timezone_name(lat, lon), dt_str)
             return GeocoderResult(address, lat, lon, offset)
         return None
 
@@ -16,16 +16,19 @@ from model.sf_flatlib import FlatlibBuilder
 
 def iterate_dates(chart_foo, from_date='1900/01/01', to_date='2030/12/31', step_in_hours=12):
     cur_day = datetime.strptime(from_date, '%Y/%m/%d')
+    dates = []
+    while cur_day.strftime('%Y/%m/%d') != to_date:
+        dates.append(cur_day)
+        cur_day += timedelta(hours=step_in_hours)
+
     result = set()
     builder = FlatlibBuilder()
-    while cur_day.strftime('%Y/%m/%d') != to_date:
-        formula = builder.build_formula(cur_day)
-        formula_id = formula.get_id()
-        if chart_foo(formula) and formula_id not in result:
-            result.add(formula_id)
-            print(f'Нашёл!!! => {cur_day.strftime("%Y/%m/%d")}')
+    for formula in builder.build_formulas(dates):
+        formula_key = formula.get_key()
+        if chart_foo(formula) and formula_key not in result:
+            result.add(formula_key)
+            print(f'Нашёл!!! => {formula.dt.strftime("%Y/%m/%d")}')
             print(formula)
-        cur_day += timedelta(hours=step_in_hours)
 
 
 def print_formula(from_day, to_day):
@@ -42,14 +45,14 @@ class FormulaHistogram:
         self.formula_to_dates = {}
 
     def foo(self, formula, from_day, to_day):
-        formula_id = formula.get_id()
-        if self.formula_to_dates.get(formula_id) is None:
-            self.formula_to_dates[formula_id] = []
-        self.formula_to_dates[formula_id].append((from_day, to_day))
+        formula_key = formula.get_key()
+        if self.formula_to_dates.get(formula_key) is None:
+            self.formula_to_dates[formula_key] = []
+        self.formula_to_dates[formula_key].append((from_day, to_day))
 
     def print_result(self):
         results = []
-        for formula_id, formula_dates in self.formula_to_dates.items():
+        for formula_key, formula_dates in self.formula_to_dates.items():
             minutes_cnt = 0
             for fr, to in formula_dates:
                 minutes_cnt += (to - fr).total_seconds() / 60.0
@@ -1,20 +1,21 @@
-import base64
 import configparser
-import os
 from urllib.parse import unquote
 
 import pytz
 
-from flask import Flask, request, render_template, send_file, redirect, send_from_directory
+from flask import Flask, request, render_template, redirect, send_from_directory, make_response
 from datetime import datetime, timedelta
 
 from transliterate import translit
 
 from logging.config import dictConfig
 
+from app.app_cache import render_cache, PNG_SIGNATURE
 from app.app_sf import generate_full_card, generate_card
-from app.app_transit import generate_transit, generate_full_transit, get_nearest_transit_connections
+from app.app_transit import generate_transit, generate_full_transit, get_nearest_transit_connections, \
+    get_connection_pic, prepare_connection_pics
 from ext.sf_geocoder import DefaultSFGeocoder
+from model.sf_transit import init_transit_pool, TRANSIT_PLANETS
 
 dictConfig({
     'version': 1,
@@ -161,8 +162,21 @@ def download_card():
     fio, birthday, city, age_units = get_card_params()
 
     birthday_unified = birthday.strftime('%Y-%m-%d %H:%M')
-    filename = generate_full_card(geocoder, fio, f'{birthday_unified}', city, age_units)
-    return send_file(filename)
+    key, pdf = generate_full_card(geocoder, fio, f'{birthday_unified}', city, age_units)
+    return make_cached_response(key, pdf, 'application/pdf', download_name=get_card_file_name(fio, birthday))
+
+
+def get_file_name_prefix(fio: str) -> str:
+    name_tr = translit(fio, "ru", reversed=True)
+    return name_tr.replace(' ', '_').replace('\'', '').lower()
+
+
+def get_card_file_name(fio: str, birthday: datetime) -> str:
+    return f'{get_file_name_prefix(fio)}_{birthday.strftime("%Y-%m-%d")}.pdf'
+
+
+def get_transit_file_name(fio: str, birthday: datetime, transit_day: datetime) -> str:
+    return f'{get_file_name_prefix(fio)}_tr{birthday.strftime("%Y-%m-%d")}_to{transit_day.strftime("%Y-%m-%d")}.pdf'
 
 
 def get_card_params():
@@ -184,11 +198,9 @@ def create_card():
     birthday_as_str = birthday.strftime('%d.%m.%Y %H:%M')
 
     birthday_unified = birthday.strftime('%Y-%m-%d %H:%M')
-    filename = generate_card(geocoder, fio, f'{birthday_unified}', city, age_units)
+    key, _ = generate_card(geocoder, fio, f'{birthday_unified}', city, age_units)
 
-    name_tr = translit(fio, "ru", reversed=True)
-    name_tr = name_tr.replace(' ', '_').replace('\'', '').lower()
-    out_file = f'{name_tr}_{birthday_unified[:10]}.pdf'
+    out_file = get_card_file_name(fio, birthday)
 
     age_in_years = '&age-in-years=on' if age_units == 'years' else ''
     link = '/download-card?fio=' + unquote(fio) + '&birthday=' + unquote(birthday_as_str) \
@@ -197,13 +209,10 @@ def create_card():
     transit_link = '/transit?' + unquote_str_param('fio', fio) + \
                    unquote_str_param('birthday', birthday_as_str) + unquote_str_param('city', city)
 
-    with open(filename, "rb") as img_file:
-        b64_string = base64.b64encode(img_file.read()).decode('utf-8')
-        os.remove(filename)
-        return render_template('card.html', img_as_base64=b64_string,
-                               fio=fio, birthday=birthday_as_str, city=city,
-                               out_file_name=out_file, download_link=link, age_in_years=age_units == 'years',
-                               transit_link=transit_link)
+    return render_template('card.html', img_url=get_render_url(key, 'card'),
+                           fio=fio, birthday=birthday_as_str, city=city,
+                           out_file_name=out_file, download_link=link, age_in_years=age_units == 'years',
+                           transit_link=transit_link)
 
 
 def get_transit_params():
@@ -259,14 +268,10 @@ def create_transit():
     birthday = birthday_dt.strftime('%d.%m.%Y %H:%M')
     transit_day = transit_dt.strftime('%d.%m.%Y %H:%M')
 
-    filename = generate_transit(geocoder, birthday_dt, city, transit_dt, cur_city,
-                                show_source, show_source_to_transit, show_transit)
+    key, _ = generate_transit(geocoder, birthday_dt, city, transit_dt, cur_city,
+                              show_source, show_source_to_transit, show_transit)
 
-    name_tr = translit(fio, "ru", reversed=True)
-    name_tr = name_tr.replace(' ', '_').replace('\'', '').lower()
-    birthday_unified = birthday_dt.strftime('%Y-%m-%d %H:%M')
-    transit_day_unified = transit_dt.strftime('%Y-%m-%d %H:%M')
-    out_file = f'{name_tr}_tr{birthday_unified[:10]}_to{transit_day_unified[:10]}.pdf'
+    out_file = get_transit_file_name(fio, birthday_dt, transit_dt)
 
     params = unquote_str_param('fio', fio) + unquote_str_param('birthday', birthday) + \
              unquote_str_param('city', city) + unquote_str_param('current-city', cur_city) + \
@@ -300,16 +305,13 @@ def create_transit():
         planet_to_connection_res.append((planet, planet_to, dt.strftime('%d.%m.%Y'), tr_link, dt))
     planet_to_connection_res.sort(key=lambda a: a[4])
 
-    with open(filename, "rb") as img_file:
-        b64_string = base64.b64encode(img_file.read()).decode('utf-8')
-        os.remove(filename)
-        return render_template('transit.html', img_as_base64=b64_string,
-                               fio=fio, birthday=birthday, city=city, transit_day=transit_day, current_city=cur_city,
-                               out_file_name=out_file, download_link=link, prev_link=prev_link, next_link=next_link,
-                               prev_link_hour=prev_link_hour, next_link_hour=next_link_hour,
-                               show_source=show_source, show_source_to_transit=show_source_to_transit,
-                               show_transit=show_transit, fd_link=fd_link,
-                               planet_to_connection=planet_to_connection_res, planet_to_connection_view=planet_to_view)
+    return render_template('transit.html', img_url=get_render_url(key, 'transit'),
+                           fio=fio, birthday=birthday, city=city, transit_day=transit_day, current_city=cur_city,
+                           out_file_name=out_file, download_link=link, prev_link=prev_link, next_link=next_link,
+                           prev_link_hour=prev_link_hour, next_link_hour=next_link_hour,
+                           show_source=show_source, show_source_to_transit=show_source_to_transit,
+                           show_transit=show_transit, fd_link=fd_link,
+                           planet_to_connection=planet_to_connection_res, planet_to_connection_view=planet_to_view)
 
 
 @app.route('/download-tr', methods=['GET'])
@@ -318,9 +320,68 @@ def download_transit():
     fio, birthday_dt, city, transit_dt, cur_city, show_source, show_source_to_transit, show_transit = \
         get_transit_params()
 
-    filename = generate_full_transit(geocoder, fio, birthday_dt, city, transit_dt, cur_city,
+    key, pdf = generate_full_transit(geocoder, fio, birthday_dt, city, transit_dt, cur_city,
                                      show_source, show_source_to_transit, show_transit)
-    return send_file(filename)
+    return make_cached_response(key, pdf, 'application/pdf',
+                                download_name=get_transit_file_name(fio, birthday_dt, transit_dt))
+
+
+def get_render_url(key: str, kind: str) -> str:
+    # параметры страницы идут в адрес картинки, чтобы её можно было нарисовать заново, если она вытеснена из кэша
+    return f'/render/{key}.png?kind={kind}&{request.query_string.decode()}'
+
+
+def render_by_params(kind: str) -> (str, bytes):
+    if kind == 'card':
+        fio, birthday, city, age_units = get_card_params()
+        return generate_card(geocoder, fio, birthday.strftime('%Y-%m-%d %H:%M'), city, age_units)
+    if kind == 'transit':
+        _, birthday_dt, city, transit_dt, cur_city, show_source, show_source_to_transit, show_transit = \
+            get_transit_params()
+        return generate_transit(geocoder, birthday_dt, city, transit_dt, cur_city,
+                                show_source, show_source_to_transit, show_transit)
+    return None, None
+
+
+def make_cached_response(key: str, data: bytes, mimetype: str, download_name: str = None):
+    # ключ кэша зависит только от входных данных картинки, поэтому годится как ETag,
+    # а сама картинка по этому адресу никогда не меняется
+    response = make_response(data)
+    response.mimetype = mimetype
+    if download_name:
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.set_etag(key)
+    response.cache_control.public = True
+    response.cache_control.max_age = 30 * 24 * 60 * 60
+    return response.make_conditional(request)
+
+
+@app.route('/connection/<int:planet1>-<int:planet2>-<int:retro1>-<int:retro2>.png', methods=['GET'])
+def get_connection(planet1, planet2, retro1, retro2):
+    if planet1 >= len(TRANSIT_PLANETS) or planet2 >= len(TRANSIT_PLANETS):
+        return page_not_found(None)
+    pic = get_connection_pic(TRANSIT_PLANETS[planet1], TRANSIT_PLANETS[planet2], retro1 == 1, retro2 == 1)
+    return make_cached_response(f'{planet1}-{planet2}-{retro1}-{retro2}', pic, 'image/png')
+
+
+@app.route('/render/<key>.png', methods=['GET'])
+def get_render(key):
+    # по этому адресу отдаются только картинки карточки и транзита; PDF из того же кэша сюда не попадают
+    kind = request.args.get('kind')
+    if not render_cache.is_key(key) or kind not in ['card', 'transit']:
+        return page_not_found(None)
+    data = render_cache.get(key)
+    if data is not None and not data.startswith(PNG_SIGNATURE):
+        return page_not_found(None)
+    if data is None:
+        # картинка вытеснена из кэша: рисуем её заново по параметрам страницы; если с тех пор ключ поменялся
+        # (например, сменился день), отправляем на адрес новой картинки
+        new_key, data = render_by_params(kind)
+        if new_key is None:
+            return page_not_found(None)
+        if new_key != key:
+            return redirect(f'/render/{new_key}.png?{request.query_string.decode()}')
+    return make_cached_response(key, data, 'image/png')
 
 
 @app.errorhandler(500)
@@ -341,7 +402,12 @@ if __name__ == '__main__':
     geocoder = DefaultSFGeocoder(config.get('Geocoder', 'token'))
 
     debug = False
+    transit_processes = None
     if config.has_section('App'):
         debug = config.get('App', 'debug')
+        if config.has_option('App', 'transit_processes'):
+            transit_processes = config.getint('App', 'transit_processes')
+    init_transit_pool(transit_processes)
+    prepare_connection_pics()
 
     app.run(debug=debug, port=8080)
@@ -1,5 +1,6 @@
 import csv
 from datetime import datetime, timedelta
+from multiprocessing import Pool
 
 import cairo
 from transliterate import translit
@@ -8,6 +9,7 @@ from model.sf_flatlib import FlatlibBuilder
 from view.sf_cairo import SimpleFormulaDrawer
 from view.sf_layout import DefaultLayoutMaker, RectangleFormulaCutter
 from view.sf_layout_angles import AnglesLayoutMaker, RectangleCutPolicy
+from view.sf_layout_cache import layout_cache
 
 
 class Person:
@@ -76,7 +78,9 @@ if __name__ == '__main__':
 
     builder = FlatlibBuilder()
     # layout_maker = DefaultLayoutMaker(RectangleFormulaCutter(formula_width, formula_height))
-    layout_maker = AnglesLayoutMaker()
+    # сложные формулы со многими центрами раскладываются дольше всего: их варианты поворотов считаются в пуле
+    pool = Pool()
+    layout_maker = AnglesLayoutMaker(layout_cache=layout_cache, executor=pool)
     drawer = SimpleFormulaDrawer()
 
     rows = read_csv_file(path_to_csv)
@@ -143,3 +147,4 @@ if __name__ == '__main__':
 
         surface_pdf.finish()
 
+    pool.close()
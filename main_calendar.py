@@ -1,6 +1,8 @@
 from datetime import datetime, timedelta
 
 from model.sf import SoulFormulaWithBorders
+from model.sf_ephemeris import dt_to_jd
+from model.sf_events import get_event_index
 from model.sf_flatlib import FlatlibBuilder
 from view.sf_printer import PDFPrinter
 
@@ -11,16 +13,35 @@ if __name__ == '__main__':
 
     dt = datetime.strptime('2021-11-04 12:00', '%Y-%m-%d %H:%M')
     dt_end = datetime.strptime('2022-01-10 12:00', '%Y-%m-%d %H:%M')
-    prev_id = ''
+    dates = []
     while dt <= dt_end:
-        print(dt)
+        dates.append(dt)
+        dt += timedelta(days=1)
 
-        formula = builder.build_formula(dt)
-        id = formula.get_id()
-        if id != prev_id:
-            printer.formulas.append(SoulFormulaWithBorders(formula, dt, dt))
+    index = get_event_index()
+    if index is not None and index.contains(dt_to_jd(dates[0])) and index.contains(dt_to_jd(dates[-1])):
+        # границы формул берутся из индекса событий, карты строятся только для новых формул
+        prev_interval = None
+        for dt in dates:
+            print(dt)
 
-        prev_id = id
-        dt += timedelta(days=1)
+            interval = index.get_interval(dt_to_jd(dt))
+            if interval != prev_interval:
+                formula = builder.build_formula_by_index(dt)
+                printer.formulas.append(SoulFormulaWithBorders(formula, dt, dt))
+
+            prev_interval = interval
+    else:
+        prev_key = None
+        for formula in builder.build_formulas(dates):
+            print(formula.dt)
+
+            key = formula.get_key()
+            if key != prev_key:
+                # для печати нужна полная формула вместе с Парсом Фортуны
+                formula = builder.build_formula(formula.dt)
+                printer.formulas.append(SoulFormulaWithBorders(formula, formula.dt, formula.dt))
+
+            prev_key = key
 
     printer.print_formulas()
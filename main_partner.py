@@ -41,12 +41,15 @@ def find_partner_birthday(name, birthday_time, city, gender:str, cur_city='Мо
     print(f'На орбите {orbit_name} расположены следующие планеты: {planets}.')
 
     results = []
-    result_ids = set()
+    result_keys = set()
 
+    dates = []
     dt = dt_from
     while dt <= dt_to:
-        sf = builder.build_formula(dt, lat=geo_res_now.lat, lon=geo_res_now.lon)
+        dates.append(dt)
+        dt += timedelta(days=1)
 
+    for sf in builder.build_formulas(dates):
         partner_planets_in_partners_orbit = sf.orbits.get(partner_partners_orbit, [])
 
         partner_is_match = True
@@ -73,12 +76,10 @@ def find_partner_birthday(name, birthday_time, city, gender:str, cur_city='Мо
                         break
 
         is_center_similar = len(sf.center_set.intersection(sf_birthday.center_set)) > 0
-        sf_id = sf.get_id()
-        if partner_is_match and is_center_similar and sf_id not in result_ids:
-            result_ids.add(sf_id)
-            results.append(sf)
-
-        dt += timedelta(days=1)
+        sf_key = sf.get_key()
+        if partner_is_match and is_center_similar and sf_key not in result_keys:
+            result_keys.add(sf_key)
+            results.append(builder.build_formula(sf.dt, lat=geo_res_now.lat, lon=geo_res_now.lon))
 
     if len(results) > 0:
         name_tr = translit(name, "ru", reversed=True)
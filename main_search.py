@@ -1,8 +1,12 @@
+import os
+
 import cairo
 from flatlib import const
 
-from borders import iterate_borders
+from borders import iterate_borders, make_catalog
 from model.sf import SoulFormulaWithBorders
+from model.sf_catalog import get_catalog_file_name
+from model.sf_query import FormulaTable
 from view.sf_cairo import SimpleFormulaDrawer
 from view.sf_layout import DefaultLayoutMaker
 from view.sf_printer import PDFPrinter
@@ -23,6 +27,10 @@ def all_in_center(formula, from_day, to_day):
     return len(formula.center_set) == 10
 
 
+def all_in_center_mask(table):
+    return table.center_size() == 10
+
+
 def mercury_in_exclusion_zone(formula, from_day, to_day):
     to_mercury_links = formula.reverse_links.get(const.MERCURY, [])
     if const.MERCURY in formula.retro and \
@@ -35,6 +43,10 @@ def mercury_in_exclusion_zone(formula, from_day, to_day):
     return False
 
 
+def mercury_in_exclusion_zone_mask(table):
+    return ExclusionZoneFinder(const.MERCURY).search_mask(table)
+
+
 def mars_in_exclusion_zone(formula, from_day, to_day):
     to_mars_links = formula.reverse_links.get(const.MARS, [])
     if const.MARS in formula.retro and \
@@ -47,6 +59,10 @@ def mars_in_exclusion_zone(formula, from_day, to_day):
     return False
 
 
+def mars_in_exclusion_zone_mask(table):
+    return ExclusionZoneFinder(const.MARS).search_mask(table)
+
+
 class ExclusionZoneFinder:
 
     def __init__(self, planet) -> None:
@@ -61,6 +77,12 @@ class ExclusionZoneFinder:
             return True
         return False
 
+    def search_mask(self, table):
+        return table.retro(self.planet) & \
+            table.in_center(self.planet) & \
+            (table.reverse_links_count(self.planet) == 1) & \
+            table.links_to(self.planet, self.planet)
+
 
 class HolidaysZoneFinder:
 
@@ -76,6 +98,12 @@ class HolidaysZoneFinder:
             return True
         return False
 
+    def search_mask(self, table):
+        return ~table.retro(self.planet) & \
+            table.in_center(self.planet) & \
+            (table.reverse_links_count(self.planet) == 1) & \
+            table.links_to(self.planet, self.planet)
+
 
 class PlanetInOrbitFinder:
 
@@ -86,6 +114,9 @@ class PlanetInOrbitFinder:
     def search_function(self, formula, from_day, to_day):
         return self.planet in formula.orbits.get(self.orbit_num, [])
 
+    def search_mask(self, table):
+        return table.in_orbit(self.planet, self.orbit_num)
+
 
 def all_in_center_circle(formula, from_day, to_day):
     if len(formula.center) == 1 and len(formula.center_set) == 10:
@@ -95,6 +126,10 @@ def all_in_center_circle(formula, from_day, to_day):
     return False
 
 
+def all_in_center_circle_mask(table):
+    return (table.center_count == 1) & (table.center_size() == 10)
+
+
 def all_in_first_orbit(formula, from_day, to_day):
     if len(formula.orbits.get(1, [])) + len(formula.center_set) == 10 \
             and len(formula.center_set) <= 3:
@@ -104,6 +139,10 @@ def all_in_first_orbit(formula, from_day, to_day):
     return False
 
 
+def all_in_first_orbit_mask(table):
+    return (table.orbit_size(1) + table.center_size() == 10) & (table.center_size() <= 3)
+
+
 def max_in_second_orbit(formula, from_day, to_day):
     if len(formula.orbits.get(2, [])) >= 6:
         print(from_day, '–', to_day)
@@ -112,6 +151,10 @@ def max_in_second_orbit(formula, from_day, to_day):
     return False
 
 
+def max_in_second_orbit_mask(table):
+    return table.orbit_size(2) >= 6
+
+
 def max_in_third_orbit(formula, from_day, to_day):
     if len(formula.orbits.get(3, [])) >= 5:
         print(from_day, '–', to_day)
@@ -120,6 +163,10 @@ def max_in_third_orbit(formula, from_day, to_day):
     return False
 
 
+def max_in_third_orbit_mask(table):
+    return table.orbit_size(3) >= 5
+
+
 def max_in_fourth_orbit(formula, from_day, to_day):
     if len(formula.orbits.get(4, [])) >= 5:
         print(from_day, '–', to_day)
@@ -128,6 +175,10 @@ def max_in_fourth_orbit(formula, from_day, to_day):
     return False
 
 
+def max_in_fourth_orbit_mask(table):
+    return table.orbit_size(4) >= 5
+
+
 def max_in_fifth_orbit(formula, from_day, to_day):
     if len(formula.orbits.get(5, [])) >= 5:
         print(from_day, '–', to_day)
@@ -136,6 +187,10 @@ def max_in_fifth_orbit(formula, from_day, to_day):
     return False
 
 
+def max_in_fifth_orbit_mask(table):
+    return table.orbit_size(5) >= 5
+
+
 def max_in_sixth_orbit(formula, from_day, to_day):
     if len(formula.orbits.get(6, [])) >= 4:
         print(from_day, '–', to_day)
@@ -144,6 +199,10 @@ def max_in_sixth_orbit(formula, from_day, to_day):
     return False
 
 
+def max_in_sixth_orbit_mask(table):
+    return table.orbit_size(6) >= 4
+
+
 def max_in_seventh_orbit(formula, from_day, to_day):
     if len(formula.orbits.get(7, [])) >= 2:
         print(from_day, '–', to_day)
@@ -152,6 +211,10 @@ def max_in_seventh_orbit(formula, from_day, to_day):
     return False
 
 
+def max_in_seventh_orbit_mask(table):
+    return table.orbit_size(7) >= 2
+
+
 def max_personal_score(formula, from_day, to_day):
     planets = [const.SUN, const.MOON, const.MERCURY, const.VENUS, const.MARS]
     score = 0
@@ -163,20 +226,54 @@ def max_personal_score(formula, from_day, to_day):
     return False
 
 
+def max_personal_score_mask(table):
+    planets = [const.SUN, const.MOON, const.MERCURY, const.VENUS, const.MARS]
+    return sum(table.planet_power(planet) for planet in planets) >= 29
+
+
 def do_search(out_path, title, search_foo):
-    print(f'Запускаю поиск «{title}», результаты будут в {out_path}.')
+    do_searches([(title, search_foo, out_path)])
 
-    storage = FormulaStorage(search_foo)
 
-    # iterate_borders('data/borders_1900_2100.csv', storage.process_formula)
-    # full_title = f'{title}, с 1900 по 2100 гг'
+def do_searches(searches):
+    # все условия проверяются за один проход по формулам, у каждого поиска своё хранилище и свой PDF
+    for title, _, out_path in searches:
+        print(f'Запускаю поиск «{title}», результаты будут в {out_path}.')
+
+    storages = [FormulaStorage(search_foo) for _, search_foo, _ in searches]
+
+    def process_formula(formula, from_day, to_day):
+        for storage in storages:
+            storage.process_formula(formula, from_day, to_day)
+
+    # iterate_borders('data/borders_1900_2100.csv', process_formula)
+    # period = 'с 1900 по 2100 гг'
+
+    iterate_borders('data/borders_1300_2999.csv', process_formula)
+    period = 'с 1300 по 2999 гг'
+
+    for (title, _, out_path), storage in zip(searches, storages):
+        printer = PDFPrinter(out_path, title=f'{title}, {period}', date_as_interval=True)
+
+        for formula in storage.formulas:
+            printer.formulas.append(formula)
+
+        printer.print_formulas()
+
+
+def do_table_search(out_path, title, search_mask_foo):
+    # то же, что do_search, но условие считается сразу по всем формулам каталога
+    print(f'Запускаю поиск «{title}», результаты будут в {out_path}.')
 
-    iterate_borders('data/borders_1300_2999.csv', storage.process_formula)
+    borders_file_name = 'data/borders_1300_2999.csv'
+    if not os.path.exists(get_catalog_file_name(borders_file_name)):
+        make_catalog(borders_file_name)
+    table = FormulaTable.load(borders_file_name)
     full_title = f'{title}, с 1300 по 2999 гг'
 
     printer = PDFPrinter(out_path, title=full_title, date_as_interval=True)
 
-    for formula in storage.formulas:
+    for formula in table.select_formulas(search_mask_foo(table)):
         printer.formulas.append(formula)
 
     printer.print_formulas()
@@ -184,16 +281,21 @@ def do_search(out_path, title, search_foo):
 
 if __name__ == '__main__':
 
-    # do_search('pic/out_mercury_in_exclusion_zone.pdf', 'Меркурий в зоне отчуждения', mercury_in_exclusion_zone)
-    # do_search('pic/out_mars_in_exclusion_zone.pdf', 'Марс в зоне отчуждения', mars_in_exclusion_zone)
-    # do_search('pic/out_all_in_center.pdf', 'Все планеты в центре', all_in_center)
-    do_search('pic/out_all_in_center_circle.pdf', 'Все планеты в центре и образуют цикл', all_in_center_circle)
-    # do_search('pic/out_orbit1_max.pdf', 'Только первая орбита, в центре <= 3 планет', all_in_first_orbit)
-    # do_search('pic/out_orbit2_max.pdf', 'На второй орбите 6 и более планет', max_in_second_orbit)
-    # do_search('pic/out_orbit3_max.pdf', 'На третьей орбите 5 и более планет', max_in_third_orbit)
-    # do_search('pic/out_orbit4_max.pdf', 'На четвёртой орбите 5 и более планет', max_in_fourth_orbit)
-    # do_search('pic/out_orbit5_max.pdf', 'На пятой орбите 5 и более планет', max_in_fifth_orbit)
-    # do_search('pic/out_orbit6_max.pdf', 'На шестой орбите 4 и более планет', max_in_sixth_orbit)
-    # do_search('pic/out_orbit7_max.pdf', 'На седьмой орбите 2 и более планет', max_in_seventh_orbit)
-
-    # do_search('pic/personal_score_max.pdf', 'Cумма баллов по личным планетам >= 29', max_personal_score)
+    do_table_search('pic/out_all_in_center_circle.pdf', 'Все планеты в центре и образуют цикл',
+                    all_in_center_circle_mask)
+
+    searches = [
+        # ('Меркурий в зоне отчуждения', mercury_in_exclusion_zone, 'pic/out_mercury_in_exclusion_zone.pdf'),
+        # ('Марс в зоне отчуждения', mars_in_exclusion_zone, 'pic/out_mars_in_exclusion_zone.pdf'),
+        # ('Все планеты в центре', all_in_center, 'pic/out_all_in_center.pdf'),
+        # ('Только первая орбита, в центре <= 3 планет', all_in_first_orbit, 'pic/out_orbit1_max.pdf'),
+        # ('На второй орбите 6 и более планет', max_in_second_orbit, 'pic/out_orbit2_max.pdf'),
+        # ('На третьей орбите 5 и более планет', max_in_third_orbit, 'pic/out_orbit3_max.pdf'),
+        # ('На четвёртой орбите 5 и более планет', max_in_fourth_orbit, 'pic/out_orbit4_max.pdf'),
+        # ('На пятой орбите 5 и более планет', max_in_fifth_orbit, 'pic/out_orbit5_max.pdf'),
+        # ('На шестой орбите 4 и более планет', max_in_sixth_orbit, 'pic/out_orbit6_max.pdf'),
+        # ('На седьмой орбите 2 и более планет', max_in_seventh_orbit, 'pic/out_orbit7_max.pdf'),
+        # ('Cумма баллов по личным планетам >= 29', max_personal_score, 'pic/personal_score_max.pdf'),
+    ]
+    if searches:
+        do_searches(searches)
@@ -28,8 +28,7 @@ def print_user_info(name, birthday_time, city, death_time=None):
     death_dt = None
     if death_time is not None:
         death_dt = datetime.strptime(f'{death_time} {geo_res.utc_offset}', '%Y-%m-%d %H:%M %z')
-    formula = builder.build_formula(dt, lat=geo_res.lat, lon=geo_res.lon)
-    cosmogram = builder.build_cosmogram(dt, lat=geo_res.lat, lon=geo_res.lon, death_dt=death_dt)
+    formula, cosmogram = builder.build_snapshot(dt, lat=geo_res.lat, lon=geo_res.lon, death_dt=death_dt)
     start_dt, end_dt = get_borders(dt, lat=geo_res.lat, lon=geo_res.lon)
 
     surface_pdf = cairo.PDFSurface(
@@ -1,5 +1,6 @@
 from abc import abstractmethod
 
+import numpy as np
 import pytz
 from flatlib import const
 from datetime import datetime, timedelta
@@ -91,8 +92,36 @@ NUMBER_TO_PLANET = {
     9: (const.MARS, (1, 0, 0))
 }
 
+# объекты, ссылки и ретроградность которых составляют идентификатор формулы (get_id, get_key), и планеты,
+# на которые они могут ссылаться
+FORMULA_KEY_TARGETS = [const.SUN, const.MOON,
+                       const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
+                       const.URANUS, const.NEPTUNE, const.PLUTO]
+FORMULA_KEY_PLANETS = FORMULA_KEY_TARGETS + [const.CHIRON, const.NORTH_NODE, 'Lilith', 'Selena']
+
+
+def formula_key_to_id(key: int) -> str:
+    retro_bits = key & ((1 << len(FORMULA_KEY_PLANETS)) - 1)
+    links_num = key >> len(FORMULA_KEY_PLANETS)
+
+    def planet_to_char(planet):
+        if retro_bits & (1 << FORMULA_KEY_PLANETS.index(planet)):
+            return PLANET_TO_CHAR[planet] + 'ⸯ'
+        return PLANET_TO_CHAR[planet]
+
+    res = []
+    for planet in FORMULA_KEY_PLANETS:
+        links_num, target = divmod(links_num, len(FORMULA_KEY_TARGETS))
+        res.append(planet_to_char(planet) + planet_to_char(FORMULA_KEY_TARGETS[target]))
+    return '|'.join(res)
+
 
 class SoulFormula:
+    # формул в поиске и гистограммах сотни тысяч: без __dict__ они заметно меньше,
+    # а производные структуры строятся только при первом обращении
+    __slots__ = ('dt', 'retro', 'orbits', 'center', 'links', 'planet_power', 'additional_objects',
+                 '__key', '__reverse_links', '__center_set', '__own_orbits')
+
     def __init__(self, dt: datetime, links: {str, str}, center: [[str]], orbits: {int: [str]},
                  retro: {str}, planet_power: {str: int}, additional_objects: {str: str}) -> None:
         self.dt = dt
@@ -102,25 +131,44 @@ class SoulFormula:
         self.links = links
         self.planet_power = planet_power
         self.additional_objects = additional_objects
-
-        self.reverse_links = {}
-        for from_planet, to_planet in links.items():
-            planets = self.reverse_links.get(to_planet)
-            if not planets:
-                planets = []
-                self.reverse_links[to_planet] = planets
-            planets.append(from_planet)
-
-        self.center_set = set()
-        for center in self.center:
-            for p in center:
-                self.center_set.add(p)
-
-        self.own_orbits = set()
-        for orbit_num, planets in orbits.items():
-            for planet in planets:
-                if ORBIT_LABELS[orbit_num - 1] == planet:
-                    self.own_orbits.add(planet)
+        self.__key = None
+        self.__reverse_links = None
+        self.__center_set = None
+        self.__own_orbits = None
+
+    @property
+    def reverse_links(self) -> {str: [str]}:
+        if self.__reverse_links is None:
+            reverse_links = {}
+            for from_planet, to_planet in self.links.items():
+                planets = reverse_links.get(to_planet)
+                if not planets:
+                    planets = []
+                    reverse_links[to_planet] = planets
+                planets.append(from_planet)
+            self.__reverse_links = reverse_links
+        return self.__reverse_links
+
+    @property
+    def center_set(self) -> {str}:
+        if self.__center_set is None:
+            center_set = set()
+            for center in self.center:
+                for p in center:
+                    center_set.add(p)
+            self.__center_set = center_set
+        return self.__center_set
+
+    @property
+    def own_orbits(self) -> {str}:
+        if self.__own_orbits is None:
+            own_orbits = set()
+            for orbit_num, planets in self.orbits.items():
+                for planet in planets:
+                    if ORBIT_LABELS[orbit_num - 1] == planet:
+                        own_orbits.add(planet)
+            self.__own_orbits = own_orbits
+        return self.__own_orbits
 
     def __str__(self) -> str:
         res = self.dt.strftime('%Y-%m-%d %H:%M')
@@ -152,14 +200,24 @@ class SoulFormula:
         return p_char
 
     def get_id(self):
-        res = []
-        for planet in [const.SUN, const.MOON,
-                       const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
-                       const.URANUS, const.NEPTUNE, const.PLUTO]:
-            res.append(self.__planet_to_char(planet) + self.__planet_to_char(self.links[planet]))
-        for planet in [const.CHIRON, const.NORTH_NODE, 'Lilith', 'Selena']:
-            res.append(self.__planet_to_char(planet) + self.__planet_to_char(self.additional_objects[planet]))
-        return '|'.join(res)
+        return formula_key_to_id(self.get_key())
+
+    def get_key(self) -> int:
+        # то же, что get_id, но числом: ссылки объектов — цифры в десятичной записи, ретроградность — младшие биты
+        if self.__key is None:
+            links_num = 0
+            for planet in reversed(FORMULA_KEY_PLANETS):
+                if planet in self.links:
+                    to_planet = self.links[planet]
+                else:
+                    to_planet = self.additional_objects[planet]
+                links_num = links_num * len(FORMULA_KEY_TARGETS) + FORMULA_KEY_TARGETS.index(to_planet)
+            retro_bits = 0
+            for i, planet in enumerate(FORMULA_KEY_PLANETS):
+                if planet in self.retro:
+                    retro_bits |= 1 << i
+            self.__key = (links_num << len(FORMULA_KEY_PLANETS)) | retro_bits
+        return self.__key
 
     def get_patterns(self):
         res = []
@@ -188,6 +246,7 @@ class SoulFormula:
 
 
 class SoulFormulaWithBorders:
+    __slots__ = ('to_dt', 'from_dt', 'formula')
 
     def __init__(self, formula: SoulFormula, from_dt: datetime, to_dt: datetime) -> None:
         self.to_dt = to_dt
@@ -196,6 +255,7 @@ class SoulFormulaWithBorders:
 
 
 class CosmogramPlanet:
+    __slots__ = ('name', 'movement', 'signlon', 'sign', 'lat', 'lon', 'power')
 
     def __init__(self, name: str, lon: float, lat: float, sign: str, signlon: float,
                  movement: str, power: int) -> None:
@@ -214,7 +274,29 @@ class CosmogramPlanet:
         return self.__str__()
 
 
+ASPECT_PLANETS = [const.SUN, const.MOON,
+                  const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
+                  const.URANUS, const.NEPTUNE, const.PLUTO, const.CHIRON, const.NORTH_NODE, 'Lilith', 'Selena']
+ASPECT_ANGLES = np.array(MAJOR_ASPECTS, dtype=float)
+
+
+def _get_aspect_orb(planet1: str, planet2: str) -> int:
+    # у Солнца и Луны орбис 10°, у остальных планет 5°, между дополнительными объектами 2°
+    if planet1 in [const.SUN, const.MOON] or planet2 in [const.SUN, const.MOON]:
+        return 10
+    additional_objects = [const.CHIRON, const.NORTH_NODE, 'Lilith', 'Selena']
+    if planet1 not in additional_objects or planet2 not in additional_objects:
+        return 5
+    return 2
+
+
+ASPECT_ORBS = np.array([[_get_aspect_orb(p1, p2) for p2 in ASPECT_PLANETS] for p1 in ASPECT_PLANETS], dtype=float)
+ASPECT_PAIRS = np.triu(np.ones((len(ASPECT_PLANETS), len(ASPECT_PLANETS)), dtype=bool), k=1)
+
+
 class Cosmogram:
+    __slots__ = ('additional_planets', 'dt', 'cur_time', 'death_dt', 'planet_to_cosmogram_info',
+                 '__planet_to_aspect', '__aspects', '__sign_to_planet')
 
     def __init__(self, dt: datetime, planets: [CosmogramPlanet],
                  additional_planets: [CosmogramPlanet], death_dt: datetime = None, cur_time: datetime = None) -> None:
@@ -223,16 +305,25 @@ class Cosmogram:
         self.cur_time = datetime.now(pytz.timezone("Europe/Moscow")) if cur_time is None else cur_time
         self.death_dt = death_dt
         self.planet_to_cosmogram_info = {}
-        self.sign_to_planet = {}
         for planet in (planets + additional_planets):
             self.planet_to_cosmogram_info[planet.name] = planet
-            pp = self.sign_to_planet.get(planet.sign)
-            if pp is None:
-                pp = []
-                self.sign_to_planet[planet.sign] = pp
-            pp.append(planet)
-
-        self._calc_aspects()
+        self.__sign_to_planet = None
+        # аспекты нужны только при рисовании космограммы, поэтому считаются при первом обращении
+        self.__planet_to_aspect = None
+        self.__aspects = None
+
+    @property
+    def sign_to_planet(self) -> {str: [CosmogramPlanet]}:
+        if self.__sign_to_planet is None:
+            sign_to_planet = {}
+            for planet in self.planet_to_cosmogram_info.values():
+                pp = sign_to_planet.get(planet.sign)
+                if pp is None:
+                    pp = []
+                    sign_to_planet[planet.sign] = pp
+                pp.append(planet)
+            self.__sign_to_planet = sign_to_planet
+        return self.__sign_to_planet
 
     def get_planet_info(self, planet: str):
         result = self.planet_to_cosmogram_info.get(planet)
@@ -282,34 +373,43 @@ class Cosmogram:
         p_diff = abs(p2.lon - p1.lon)
         return min(360 - p_diff, p_diff)
 
+    @property
+    def planet_to_aspect(self) -> {str: [(str, int)]}:
+        if self.__planet_to_aspect is None:
+            self._calc_aspects()
+        return self.__planet_to_aspect
+
+    @property
+    def aspects(self) -> [int]:
+        if self.__aspects is None:
+            self._calc_aspects()
+        return self.__aspects
+
+    def get_aspect_matrix(self) -> np.ndarray:
+        # [i, j, k] — между ASPECT_PLANETS[i] и ASPECT_PLANETS[j] (i < j) есть аспект MAJOR_ASPECTS[k]
+        lon = np.array([self.planet_to_cosmogram_info[p].lon for p in ASPECT_PLANETS])
+        p_diff = np.abs(lon[np.newaxis, :] - lon[:, np.newaxis])
+        p_diff = np.minimum(360 - p_diff, p_diff)
+        diff = np.abs(p_diff[:, :, np.newaxis] - ASPECT_ANGLES)
+        return (diff <= ASPECT_ORBS[:, :, np.newaxis]) & ASPECT_PAIRS[:, :, np.newaxis]
+
     def _calc_aspects(self):
-        all_planets = [const.SUN, const.MOON,
-                       const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
-                       const.URANUS, const.NEPTUNE, const.PLUTO, const.CHIRON, const.NORTH_NODE, 'Lilith', 'Selena']
         planet_to_aspect = {}
         aspects = []
-        for i in range(len(all_planets)):
-            for j in range(i + 1, len(all_planets)):
-                for aspect in MAJOR_ASPECTS:
-                    p_diff = self.get_distance(all_planets[i], all_planets[j])
-                    diff = abs(p_diff - aspect)
-                    if diff <= 2 or \
-                            diff <= 10 and all_planets[i] in [const.SUN, const.MOON] or \
-                            diff <= 10 and all_planets[j] in [const.SUN, const.MOON] or \
-                            diff <= 5 and all_planets[i] not in [const.CHIRON, const.NORTH_NODE, 'Lilith', 'Selena'] or \
-                            diff <= 5 and all_planets[j] not in [const.CHIRON, const.NORTH_NODE, 'Lilith', 'Selena']:
-                        res1 = planet_to_aspect.get(all_planets[i], [])
-                        res2 = planet_to_aspect.get(all_planets[j], [])
-                        if len(res1) == 0:
-                            planet_to_aspect[all_planets[i]] = res1
-                        if len(res2) == 0:
-                            planet_to_aspect[all_planets[j]] = res2
-                        res1.append((all_planets[j], aspect))
-                        res2.append((all_planets[i], aspect))
-                        if aspect not in aspects:
-                            aspects.append(aspect)
-            self.planet_to_aspect = planet_to_aspect
-            self.aspects = sorted(aspects)
+        for i, j, k in zip(*np.nonzero(self.get_aspect_matrix())):
+            aspect = MAJOR_ASPECTS[k]
+            res1 = planet_to_aspect.get(ASPECT_PLANETS[i], [])
+            res2 = planet_to_aspect.get(ASPECT_PLANETS[j], [])
+            if len(res1) == 0:
+                planet_to_aspect[ASPECT_PLANETS[i]] = res1
+            if len(res2) == 0:
+                planet_to_aspect[ASPECT_PLANETS[j]] = res2
+            res1.append((ASPECT_PLANETS[j], aspect))
+            res2.append((ASPECT_PLANETS[i], aspect))
+            if aspect not in aspects:
+                aspects.append(aspect)
+        self.__planet_to_aspect = planet_to_aspect
+        self.__aspects = sorted(aspects)
 
     @staticmethod
     def _get_year_diff(cur_time, dt):
@@ -0,0 +1,89 @@
+import os
+from datetime import datetime
+
+import numpy as np
+from flatlib import const
+
+from model.sf import SoulFormula, SoulFormulaWithBorders
+from model.sf_events import minute_to_dt, dt_to_minute
+from model.sf_flatlib import FlatlibBuilder
+
+CATALOG_PLANETS = [const.SUN, const.MOON,
+                   const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
+                   const.URANUS, const.NEPTUNE, const.PLUTO]
+CATALOG_ADDITIONAL_OBJECTS = [const.CHIRON, const.NORTH_NODE, const.PARS_FORTUNA, 'Lilith', 'Selena']
+CATALOG_RETRO_PLANETS = CATALOG_PLANETS + [const.CHIRON, const.NORTH_NODE]
+
+PLANET_TO_CATALOG_INDEX = {planet: i for i, planet in enumerate(CATALOG_PLANETS)}
+
+# дополнительного объекта в формуле нет (например, Парса Фортуны у формул без места)
+NO_OBJECT = 255
+
+# одна запись — одна формула: начало и конец интервала в минутах от 1970-01-01 (UTC, включительно),
+# ссылки планет и дополнительных объектов — номера планет в CATALOG_PLANETS,
+# ретроградность — битовая маска по CATALOG_RETRO_PLANETS, сила — по CATALOG_PLANETS
+CATALOG_DTYPE = np.dtype([('start', '<i8'), ('end', '<i8'),
+                          ('links', 'u1', (len(CATALOG_PLANETS),)),
+                          ('retro', '<u2'),
+                          ('additional', 'u1', (len(CATALOG_ADDITIONAL_OBJECTS),)),
+                          ('power', 'u1', (len(CATALOG_PLANETS),))])
+
+
+def get_catalog_file_name(borders_file_name: str) -> str:
+    return os.path.splitext(borders_file_name)[0] + '.catalog'
+
+
+def formula_to_record(formula: SoulFormula, from_day: datetime, to_day: datetime) -> tuple:
+    links = [PLANET_TO_CATALOG_INDEX[formula.links[planet]] for planet in CATALOG_PLANETS]
+    retro = 0
+    for i, planet in enumerate(CATALOG_RETRO_PLANETS):
+        if planet in formula.retro:
+            retro |= 1 << i
+    additional = [PLANET_TO_CATALOG_INDEX[formula.additional_objects[planet]]
+                  if planet in formula.additional_objects else NO_OBJECT
+                  for planet in CATALOG_ADDITIONAL_OBJECTS]
+    power = [formula.planet_power[planet] for planet in CATALOG_PLANETS]
+    return dt_to_minute(from_day), dt_to_minute(to_day), links, retro, additional, power
+
+
+def record_to_formula(record) -> SoulFormulaWithBorders:
+    to_day = minute_to_dt(int(record['end']))
+    links = {planet: CATALOG_PLANETS[i] for planet, i in zip(CATALOG_PLANETS, record['links'].tolist())}
+    retro_mask = int(record['retro'])
+    retro = {planet for i, planet in enumerate(CATALOG_RETRO_PLANETS) if retro_mask & (1 << i)}
+    power = {planet: p for planet, p in zip(CATALOG_PLANETS, record['power'].tolist())}
+    additional_objects = {planet: CATALOG_PLANETS[i]
+                          for planet, i in zip(CATALOG_ADDITIONAL_OBJECTS, record['additional'].tolist())
+                          if i != NO_OBJECT}
+    formula = FlatlibBuilder.build_formula_from_links(to_day, links, retro, power, additional_objects)
+    return SoulFormulaWithBorders(formula, minute_to_dt(int(record['start'])), to_day)
+
+
+class FormulaCatalog:
+
+    def __init__(self, records: np.ndarray) -> None:
+        self.records = records
+
+    @staticmethod
+    def load(file_name: str):
+        return FormulaCatalog(np.memmap(file_name, dtype=CATALOG_DTYPE, mode='r'))
+
+    @staticmethod
+    def from_formulas(formulas: [SoulFormulaWithBorders]):
+        records = [formula_to_record(f.formula, f.from_dt, f.to_dt) for f in formulas]
+        return FormulaCatalog(np.array(records, dtype=CATALOG_DTYPE))
+
+    def save(self, file_name: str) -> None:
+        # пишем во временный файл, чтобы недописанный каталог не подхватился при поиске
+        self.records.tofile(file_name + '.tmp')
+        os.replace(file_name + '.tmp', file_name)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get_formula(self, i: int) -> SoulFormulaWithBorders:
+        return record_to_formula(self.records[i])
+
+    def iterate_formulas(self):
+        for record in self.records:
+            yield record_to_formula(record)
@@ -0,0 +1,132 @@
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import swisseph
+from flatlib import const
+from flatlib.datetime import Datetime
+from flatlib.ephem import tools
+
+EPHE_PATH = '/usr/local/share/ephe'
+
+BATCH_PLANETS = [const.SUN, const.MOON,
+                 const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
+                 const.URANUS, const.NEPTUNE, const.PLUTO, const.CHIRON, const.NORTH_NODE,
+                 'Lilith', 'Selena']
+
+PLANET_TO_SWE_ID = {
+    const.SUN: swisseph.SUN,
+    const.MOON: swisseph.MOON,
+    const.MERCURY: swisseph.MERCURY,
+    const.VENUS: swisseph.VENUS,
+    const.MARS: swisseph.MARS,
+    const.JUPITER: swisseph.JUPITER,
+    const.SATURN: swisseph.SATURN,
+    const.URANUS: swisseph.URANUS,
+    const.NEPTUNE: swisseph.NEPTUNE,
+    const.PLUTO: swisseph.PLUTO,
+    const.CHIRON: swisseph.CHIRON,
+    const.NORTH_NODE: swisseph.MEAN_NODE,
+    'Lilith': 12,
+    'Selena': 56
+}
+
+# как во flatlib: при меньшей скорости объект считается стационарным
+STATIONARY_SPEED = 0.0003
+
+
+def dt_to_jd(dt: datetime) -> float:
+    # так же, как FlatlibBuilder, чтобы юлианские дни совпадали до последнего знака
+    offset = dt.strftime('%z')
+    if not offset:
+        offset = '+00:00'
+    else:
+        offset = offset[:3] + ':' + offset[3:5]
+    return Datetime(dt.strftime('%Y/%m/%d'), dt.strftime('%H:%M'), offset).jd
+
+
+def dates_to_jd(dates: [datetime]) -> np.ndarray:
+    return np.array([dt_to_jd(dt) for dt in dates], dtype=np.float64)
+
+
+def calc_planet(jd: float, planet: str) -> (float, float, float):
+    swisseph.set_ephe_path(EPHE_PATH)
+    swe_list, _ = swisseph.calc_ut(jd, PLANET_TO_SWE_ID[planet])
+    return swe_list[0], swe_list[1], swe_list[3]
+
+
+@lru_cache(maxsize=100000)
+def calc_planet_cached(planet: str, jd: float) -> (float, float, float):
+    # для поисков, которые много раз считают один объект в одни и те же моменты (транзиты, развороты планет)
+    return calc_planet(jd, planet)
+
+
+def calc_pars_fortuna(jd: float, lat: float, lon: float) -> float:
+    # Парс Фортуны зависит от асцендента, поэтому считается для конкретного места так же, как во flatlib
+    swisseph.set_ephe_path(EPHE_PATH)
+    return tools.pfLon(jd, lat, lon)
+
+
+def get_movement(speed: float) -> str:
+    if abs(speed) < STATIONARY_SPEED:
+        return const.STATIONARY
+    elif speed > 0:
+        return const.DIRECT
+    return const.RETROGRADE
+
+
+# положения объектов на набор моментов времени: колонка массивов lon, lat, speed и sign —
+# объект из planets, строка — юлианский день из jd
+class EphemerisTable:
+
+    def __init__(self, jd: np.ndarray, planets: [str],
+                 lon: np.ndarray, lat: np.ndarray, speed: np.ndarray) -> None:
+        self.jd = jd
+        self.planets = planets
+        self.planet_to_index = {planet: i for i, planet in enumerate(planets)}
+        self.lon = lon
+        self.lat = lat
+        self.speed = speed
+        self.sign = (lon // 30).astype(np.int8) % 12
+
+    def __len__(self) -> int:
+        return len(self.jd)
+
+    def get_lon(self, planet: str) -> np.ndarray:
+        return self.lon[:, self.planet_to_index[planet]]
+
+    def get_speed(self, planet: str) -> np.ndarray:
+        return self.speed[:, self.planet_to_index[planet]]
+
+    def get_sign_index(self, planet: str) -> np.ndarray:
+        return self.sign[:, self.planet_to_index[planet]]
+
+    def get_retro_mask(self, planet: str) -> np.ndarray:
+        return self.get_speed(planet) <= -STATIONARY_SPEED
+
+    def get_signs(self, i: int) -> {str: str}:
+        return {planet: const.LIST_SIGNS[self.sign[i, j]] for j, planet in enumerate(self.planets)}
+
+    def get_retro(self, i: int) -> {str}:
+        return {planet for j, planet in enumerate(self.planets) if self.speed[i, j] <= -STATIONARY_SPEED}
+
+
+def calc_ephemeris(jd: np.ndarray, planets: [str] = None) -> EphemerisTable:
+    # считаем напрямую через swisseph, без построения карты flatlib с домами и лишними объектами
+    if planets is None:
+        planets = BATCH_PLANETS
+    jd = np.asarray(jd, dtype=np.float64)
+
+    swisseph.set_ephe_path(EPHE_PATH)
+    lon = np.empty((len(jd), len(planets)), dtype=np.float64)
+    lat = np.empty((len(jd), len(planets)), dtype=np.float64)
+    speed = np.empty((len(jd), len(planets)), dtype=np.float64)
+    for j, planet in enumerate(planets):
+        swe_id = PLANET_TO_SWE_ID[planet]
+        for i, t in enumerate(jd.tolist()):
+            swe_list, _ = swisseph.calc_ut(t, swe_id)
+            lon[i, j] = swe_list[0]
+            lat[i, j] = swe_list[1]
+            speed[i, j] = swe_list[3]
+
+    return EphemerisTable(jd, list(planets), lon, lat, speed)
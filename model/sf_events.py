@@ -0,0 +1,217 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from flatlib import const
+
+from model.sf_ephemeris import calc_ephemeris, calc_planet, dt_to_jd, BATCH_PLANETS, STATIONARY_SPEED
+
+EVENTS_FILE = 'data/events_1300_2999.bin'
+
+# объект вошёл в знак value / объект стал ретроградным (value=1) или перестал им быть (value=0) / конец индекса
+EVENT_INGRESS = 0
+EVENT_STATION = 1
+EVENT_END = 2
+
+EVENT_DTYPE = np.dtype([('jd', '<f8'), ('body', 'u1'), ('event', 'u1'), ('value', 'u1')])
+
+EVENT_PLANETS = BATCH_PLANETS
+EVENT_RETRO_PLANETS = [p for p in BATCH_PLANETS if p not in ['Lilith', 'Selena']]
+
+# события ищутся с точностью до минуты: jd события — первая минута (UTC), в которую уже новое состояние
+MINUTES_IN_DAY = 1440
+UNIX_EPOCH = datetime(1970, 1, 1)
+UNIX_EPOCH_JD = 2440587.5
+
+
+def jd_to_minute(jd: float) -> int:
+    return int(round((jd - UNIX_EPOCH_JD) * MINUTES_IN_DAY))
+
+
+def jds_to_minutes(jd: np.ndarray) -> np.ndarray:
+    return np.round((np.asarray(jd, dtype=np.float64) - UNIX_EPOCH_JD) * MINUTES_IN_DAY).astype(np.int64)
+
+
+def minute_to_jd(minute: int) -> float:
+    return UNIX_EPOCH_JD + minute / MINUTES_IN_DAY
+
+
+def minute_to_dt(minute: int) -> datetime:
+    return UNIX_EPOCH + timedelta(minutes=minute)
+
+
+def dt_to_minute(dt: datetime) -> int:
+    return jd_to_minute(dt_to_jd(dt))
+
+
+# поиск по индексу идёт по целым минутам: jd из dt_to_jd и из minute_to_jd для той же минуты различаются
+# в последнем знаке, и при поиске по jd момент ровно на границе попадал бы в предыдущую формулу
+class FormulaEventIndex:
+
+    def __init__(self, events: np.ndarray) -> None:
+        # первые записи каждого объекта задают его состояние на начало индекса
+        self.events = events
+        self.start_jd = float(events['jd'][0])
+        self.end_jd = float(events['jd'][-1])
+        self.start_minute = jd_to_minute(self.start_jd)
+        self.end_minute = jd_to_minute(self.end_jd)
+
+        self.body_events = {}
+        for body in range(len(EVENT_PLANETS)):
+            for event in [EVENT_INGRESS, EVENT_STATION]:
+                body_events = events[(events['body'] == body) & (events['event'] == event)]
+                if len(body_events) > 0:
+                    self.body_events[(body, event)] = (jds_to_minutes(body_events['jd']),
+                                                       np.ascontiguousarray(body_events['value']))
+
+        # моменты смены формулы без повторов (несколько событий в одну минуту — одна граница)
+        self.borders = np.unique(events['jd'])
+        self.border_minutes = jds_to_minutes(self.borders)
+
+    @staticmethod
+    def load(file_name: str = EVENTS_FILE):
+        return FormulaEventIndex(np.memmap(file_name, dtype=EVENT_DTYPE, mode='r'))
+
+    def save(self, file_name: str = EVENTS_FILE) -> None:
+        self.events.tofile(file_name)
+
+    def contains(self, jd: float) -> bool:
+        return self.start_minute <= jd_to_minute(jd) < self.end_minute
+
+    def get_events(self, from_jd: float, to_jd: float) -> np.ndarray:
+        jds = self.events['jd']
+        return self.events[np.searchsorted(jds, from_jd, side='left'):np.searchsorted(jds, to_jd, side='right')]
+
+    def get_state(self, jd: float) -> ({str: str}, {str}):
+        signs = {}
+        retro = set()
+        minute = jd_to_minute(jd)
+        for (body, event), (minutes, values) in self.body_events.items():
+            value = values[max(np.searchsorted(minutes, minute, side='right') - 1, 0)]
+            planet = EVENT_PLANETS[body]
+            if event == EVENT_INGRESS:
+                signs[planet] = const.LIST_SIGNS[value]
+            elif value:
+                retro.add(planet)
+        return signs, retro
+
+    def get_interval(self, jd: float) -> (float, float):
+        # [начало формулы; начало следующей формулы)
+        i = np.searchsorted(self.border_minutes, jd_to_minute(jd), side='right')
+        return float(self.borders[i - 1]), float(self.borders[i])
+
+    def iterate_intervals(self, from_jd: float, to_jd: float):
+        # идём по событиям по порядку, меняя состояние на лету, чтобы не искать его заново для каждой формулы
+        i = max(np.searchsorted(self.border_minutes, jd_to_minute(from_jd), side='right') - 1, 0)
+        signs, retro = self.get_state(float(self.borders[i]))
+        events = self.get_events(float(self.borders[i]), to_jd)[1:]
+        events = list(zip(events['jd'].tolist(), events['body'].tolist(),
+                          events['event'].tolist(), events['value'].tolist()))
+        k = 0
+        while i + 1 < len(self.borders) and self.borders[i] <= to_jd:
+            start_jd, end_jd = float(self.borders[i]), float(self.borders[i + 1])
+            while k < len(events) and events[k][0] <= start_jd:
+                jd, body, event, value = events[k]
+                planet = EVENT_PLANETS[body]
+                if event == EVENT_INGRESS:
+                    signs[planet] = const.LIST_SIGNS[value]
+                elif event == EVENT_STATION and value:
+                    retro.add(planet)
+                elif event == EVENT_STATION:
+                    retro.discard(planet)
+                k += 1
+            yield start_jd, end_jd, dict(signs), set(retro)
+            i += 1
+
+
+def _get_body_states(table, planet):
+    signs = table.get_sign_index(planet)
+    if planet in EVENT_RETRO_PLANETS:
+        retro = table.get_retro_mask(planet).astype(np.uint8)
+    else:
+        retro = None
+    return signs, retro
+
+
+def _get_value(planet: str, event: int, minute: int) -> int:
+    lon, _, speed = calc_planet(minute_to_jd(minute), planet)
+    if event == EVENT_INGRESS:
+        return int(lon // 30) % 12
+    return int(speed <= -STATIONARY_SPEED)
+
+
+def _find_event_minute(planet: str, event: int, same_minute: int, changed_minute: int, old_value: int) -> int:
+    # первая минута, в которую значение уже отличается от old_value
+    while changed_minute - same_minute > 1:
+        middle = (same_minute + changed_minute) // 2
+        if _get_value(planet, event, middle) == old_value:
+            same_minute = middle
+        else:
+            changed_minute = middle
+    return changed_minute
+
+
+def _get_scan_step(planet: str) -> int:
+    # шаг сетки в минутах: Луна проходит знак за двое с лишним суток, остальным хватает суток
+    if planet == const.MOON:
+        return MINUTES_IN_DAY // 4
+    return MINUTES_IN_DAY
+
+
+def build_event_index(from_dt: datetime, to_dt: datetime, chunk_days: int = 3650) -> FormulaEventIndex:
+    from_minute = dt_to_minute(from_dt)
+    to_minute = dt_to_minute(to_dt)
+
+    records = []
+    for body, planet in enumerate(EVENT_PLANETS):
+        step = _get_scan_step(planet)
+        chunk_start = from_minute
+        while chunk_start < to_minute:
+            # соседние куски пересекаются по одной точке, так что смены на стыке не теряются
+            chunk_end = min(chunk_start + chunk_days * MINUTES_IN_DAY, to_minute)
+            minutes = np.arange(chunk_start, chunk_end + 1, step, dtype=np.int64)
+            if minutes[-1] != chunk_end:
+                minutes = np.append(minutes, chunk_end)
+            table = calc_ephemeris(UNIX_EPOCH_JD + minutes / MINUTES_IN_DAY, [planet])
+            signs, retro = _get_body_states(table, planet)
+
+            if chunk_start == from_minute:
+                records.append((minute_to_jd(from_minute), body, EVENT_INGRESS, signs[0]))
+                if retro is not None:
+                    records.append((minute_to_jd(from_minute), body, EVENT_STATION, retro[0]))
+
+            for event, values in [(EVENT_INGRESS, signs), (EVENT_STATION, retro)]:
+                if values is None:
+                    continue
+                for i in np.nonzero(values[1:] != values[:-1])[0]:
+                    minute = _find_event_minute(planet, event, int(minutes[i]), int(minutes[i + 1]), values[i])
+                    records.append((minute_to_jd(minute), body, event, values[i + 1]))
+
+            chunk_start = chunk_end
+
+    records.append((minute_to_jd(to_minute), 0, EVENT_END, 0))
+    events = np.array(records, dtype=EVENT_DTYPE)
+    events = events[np.argsort(events['jd'], kind='stable')]
+    return FormulaEventIndex(events)
+
+
+_index = None
+
+
+def get_event_index(file_name: str = EVENTS_FILE):
+    # индекс подгружается один раз на процесс; если файла нет, возвращается None
+    global _index
+    if _index is None and os.path.exists(file_name):
+        _index = FormulaEventIndex.load(file_name)
+    return _index
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    index = build_event_index(datetime.strptime('1300/01/01', '%Y/%m/%d'),
+                              datetime.strptime('3000/01/01', '%Y/%m/%d'))
+    index.save(EVENTS_FILE)
+    final_time_spend = time.time() - start_time
+    print(f'Найдено {len(index.events)} событий за {round(final_time_spend)} сек '
+          f'({round(final_time_spend / 60.0, 1)} мин)')
@@ -9,17 +9,83 @@ from flatlib.geopos import GeoPos
 
 from ext.sf_geocoder import DefaultSFGeocoder
 from model.sf import SoulFormula, SIGN_TO_HOUSE, SoulFormulaBuilder, PLANET_POWER, Cosmogram, CosmogramPlanet
+from model.sf_ephemeris import calc_ephemeris, dates_to_jd, dt_to_jd, calc_planet, calc_pars_fortuna, \
+    get_movement, BATCH_PLANETS, STATIONARY_SPEED
+from model.sf_events import get_event_index, jd_to_minute
+from model.sf_transit_table import get_transit_table, calc_transit_planet, TRANSIT_PLANETS
 
 
 class FlatlibBuilder(SoulFormulaBuilder):
 
     def build_cosmogram(self, dt: datetime, lat=55.75322, lon=37.622513,
                         death_dt: datetime = None, planets_to_exclude=None, cur_time=None) -> Cosmogram:
+        chart, lilith, selena = self.__build_chart(dt, lat, lon)
+        return self.__chart_to_cosmogram(dt, chart, lilith, selena, death_dt, planets_to_exclude, cur_time)
+
+    def build_formula(self, dt: datetime, lat=55.75322, lon=37.622513) -> SoulFormula:
+        chart, lilith, selena = self.__build_chart(dt, lat, lon)
+        return self.__chart_to_formula(dt, chart, lilith, selena)
+
+    def build_snapshot(self, dt: datetime, lat=55.75322, lon=37.622513,
+                       death_dt: datetime = None, planets_to_exclude=None, cur_time=None) -> (SoulFormula, Cosmogram):
+        # одна карта на формулу и космограмму — положения планет считаются только один раз
+        chart, lilith, selena = self.__build_chart(dt, lat, lon)
+        formula = self.__chart_to_formula(dt, chart, lilith, selena)
+        cosmogram = self.__chart_to_cosmogram(dt, chart, lilith, selena, death_dt, planets_to_exclude, cur_time)
+        return formula, cosmogram
+
+    def build_formulas(self, dates: [datetime], chunk_size=10000):
+        # формулы для ряда дат без построения карт flatlib; Парс Фортуны зависит от домов,
+        # поэтому в additional_objects таких формул его нет (в get_id он не участвует)
+        for chunk_start in range(0, len(dates), chunk_size):
+            chunk = dates[chunk_start:chunk_start + chunk_size]
+            table = calc_ephemeris(dates_to_jd(chunk))
+            for i, dt in enumerate(chunk):
+                yield self.build_formula_from_signs(dt, table.get_signs(i), table.get_retro(i) - {'Lilith', 'Selena'})
+
+    def build_transit_cosmogram(self, dt: datetime, cur_time=None) -> Cosmogram:
+        # космограмма транзита без Парса Фортуны; если дата есть в таблице транзитов, положения берутся из неё
+        # (как и в остальных местах, рядом со стоянием планета считается напрямую — см. calc_transit_planet)
+        table = get_transit_table()
+        jd = dt_to_jd(dt)
+        if table is None or not table.contains(jd):
+            return self.build_cosmogram(dt, planets_to_exclude=[const.PARS_FORTUNA], cur_time=cur_time)
+
+        planet_infos = []
+        additional_planets = []
+        for planet in TRANSIT_PLANETS:
+            lon, lat, speed = calc_transit_planet(planet, jd)
+            sign = const.LIST_SIGNS[int(lon // 30)]
+            if planet in ['Lilith', 'Selena']:
+                additional_planets.append(CosmogramPlanet(planet, lon, lat, sign, lon % 30, const.DIRECT, 0))
+            elif planet in [const.CHIRON, const.NORTH_NODE]:
+                additional_planets.append(CosmogramPlanet(planet, lon, lat, sign, lon % 30, get_movement(speed), 0))
+            else:
+                power = self.__get_planet_power(planet, sign)
+                planet_infos.append(CosmogramPlanet(planet, lon, lat, sign, lon % 30, get_movement(speed), power))
+        return Cosmogram(dt, planet_infos, additional_planets, None, cur_time)
+
+    def build_formula_by_index(self, dt: datetime, lat=55.75322, lon=37.622513) -> SoulFormula:
+        # знаки и ретроградность берутся из индекса событий, отдельно считается только Парс Фортуны
+        index = get_event_index()
+        jd = dt_to_jd(dt)
+        if index is None or not index.contains(jd):
+            return self.build_formula(dt, lat=lat, lon=lon)
+        signs, retro = index.get_state(jd)
+        signs[const.PARS_FORTUNA] = const.LIST_SIGNS[int(calc_pars_fortuna(jd, lat, lon) // 30)]
+        return self.build_formula_from_signs(dt, signs, retro)
+
+    def __build_chart(self, dt: datetime, lat, lon) -> (Chart, dict, dict):
         date = self.__dt_to_flatlib_dt(dt)
         pos = GeoPos(lat, lon)
         swisseph.set_ephe_path('/usr/local/share/ephe')
         chart = Chart(date, pos, IDs=const.LIST_OBJECTS)
+        lilith = self.__get_lilith(date.jd, 12)
+        selena = self.__get_lilith(date.jd, 56)
+        return chart, lilith, selena
 
+    def __chart_to_cosmogram(self, dt: datetime, chart: Chart, lilith: dict, selena: dict,
+                             death_dt: datetime = None, planets_to_exclude=None, cur_time=None) -> Cosmogram:
         all_planets = [const.SUN, const.MOON,
                        const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
                        const.URANUS, const.NEPTUNE, const.PLUTO]
@@ -45,33 +111,18 @@ class FlatlibBuilder(SoulFormulaBuilder):
                                 obj.movement(), power)
             )
         if not planets_to_exclude or 'Lilith' not in planets_to_exclude:
-            lilith = self.__get_lilith(dt, 12)
             additional_planets.append(
                 CosmogramPlanet('Lilith', lilith['lon'], lilith['lat'], lilith['sign'], lilith['signlon'], const.DIRECT, 0)
             )
         if not planets_to_exclude or 'Selena' not in planets_to_exclude:
-            selena = self.__get_lilith(dt, 56)
             additional_planets.append(
                 CosmogramPlanet('Selena', selena['lon'], selena['lat'], selena['sign'], selena['signlon'], const.DIRECT, 0)
             )
 
         return Cosmogram(dt, planet_infos, additional_planets, death_dt, cur_time)
 
-    def build_formula(self, dt: datetime, lat=55.75322, lon=37.622513) -> SoulFormula:
-        date = self.__dt_to_flatlib_dt(dt)
-        pos = GeoPos(lat, lon)
-        swisseph.set_ephe_path('/usr/local/share/ephe')
-        chart = Chart(date, pos, IDs=const.LIST_OBJECTS)
-
-        f = self.__chart_to_formula(dt, chart)
-        lilith = self.__get_lilith(dt, 12)
-        selena = self.__get_lilith(dt, 56)
-        f.additional_objects['Lilith'] = SIGN_TO_HOUSE[lilith['sign']]
-        f.additional_objects['Selena'] = SIGN_TO_HOUSE[selena['sign']]
-        return f
-
-    def __get_lilith(self, dt: datetime, id: int):
-        jd = self.__dt_to_flatlib_dt(dt).jd
+    @staticmethod
+    def __get_lilith(jd: float, id: int):
         sweList, _ = swisseph.calc_ut(jd, id)
         lon = sweList[0]
         return {
@@ -104,39 +155,50 @@ class FlatlibBuilder(SoulFormulaBuilder):
             i -= 1
         raise ValueError(f'Не нашлась сила планеты для {planet} в {planet_sign}.')
 
-    def __chart_to_formula(self, dt: datetime, chart: Chart) -> SoulFormula:
+    def __chart_to_formula(self, dt: datetime, chart: Chart, lilith: dict, selena: dict) -> SoulFormula:
         # dt = datetime.strptime(str(chart.date)[1:17], '%Y/%m/%d %H:%M')
+        signs = {}
         retro = set()
+        for planet in [const.SUN, const.MOON,
+                       const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
+                       const.URANUS, const.NEPTUNE, const.PLUTO,
+                       const.CHIRON, const.NORTH_NODE, const.PARS_FORTUNA]:
+            obj = chart.getObject(planet)
+            signs[planet] = obj.sign
+            if obj.movement() == const.RETROGRADE:
+                retro.add(planet)
+        signs['Lilith'] = lilith['sign']
+        signs['Selena'] = selena['sign']
+        return self.build_formula_from_signs(dt, signs, retro)
+
+    def build_formula_from_signs(self, dt: datetime, signs: {str: str}, retro: {str}) -> SoulFormula:
         links = {}
-        center = []
-        orbits = {}
         power = {}
 
-        houses = set()
-        center_planes = set()
-
         all_planets = [const.SUN, const.MOON,
                        const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
                        const.URANUS, const.NEPTUNE, const.PLUTO]
         for planet in all_planets:
-            planet_obj = chart.getObject(planet)
-
-            if planet_obj.movement() == const.RETROGRADE:
-                retro.add(planet)
-
-            house = SIGN_TO_HOUSE[planet_obj.sign]
+            house = SIGN_TO_HOUSE[signs[planet]]
             links[planet] = house
+            power[planet] = self.__get_planet_power(planet, signs[planet])
 
-            houses.add(house)
+        additional_objects = {}
+        for additional_planet in [const.CHIRON, const.NORTH_NODE, const.PARS_FORTUNA, 'Lilith', 'Selena']:
+            if additional_planet in signs:
+                additional_objects[additional_planet] = SIGN_TO_HOUSE[signs[additional_planet]]
 
-            power[planet] = self.__get_planet_power(planet, planet_obj.sign)
+        return self.build_formula_from_links(dt, links, retro, power, additional_objects)
 
-        additional_objects = {}
-        for additional_planet in [const.CHIRON, const.NORTH_NODE, const.PARS_FORTUNA]:
-            obj = chart.getObject(additional_planet)
-            additional_objects[additional_planet] = SIGN_TO_HOUSE[obj.sign]
-            if obj.movement() == const.RETROGRADE:
-                retro.add(additional_planet)
+    @staticmethod
+    def build_formula_from_links(dt: datetime, links: {str: str}, retro: {str}, power: {str: int},
+                                 additional_objects: {str: str}) -> SoulFormula:
+        # центр и орбиты целиком определяются ссылками планет
+        center = []
+        orbits = {}
+        center_planes = set()
+        houses = set(links.values())
+        all_planets = list(links.keys())
 
         start_set = set(houses)
         while len(start_set) > 0:
@@ -176,29 +238,68 @@ class FlatlibBuilder(SoulFormulaBuilder):
         return SoulFormula(dt, links, center, orbits, retro, power, additional_objects)
 
 
+# объекты, от знака которых зависит SoulFormula.get_id(), и те из них, у которых важна ретроградность
+FORMULA_ID_PLANETS = BATCH_PLANETS
+FORMULA_RETRO_PLANETS = [p for p in BATCH_PLANETS if p not in ['Lilith', 'Selena']]
+
+# шаг в минутах, с которого начинаем искать смену формулы, и максимальный шаг;
+# Луна меняет знак не чаще раза в двое суток, поэтому за 6 часов формула не успевает смениться и вернуться
+BORDER_START_STEP = 60
+BORDER_MAX_STEP = 360
+
+
+def get_formula_state(jd: float, planets: [str] = None) -> {str: (int, bool)}:
+    # знак и ретроградность объектов — формула не меняется, пока не меняется это состояние
+    if planets is None:
+        planets = FORMULA_ID_PLANETS
+    state = {}
+    for planet in planets:
+        lon, _, speed = calc_planet(jd, planet)
+        state[planet] = (int(lon // 30) % 12, planet in FORMULA_RETRO_PLANETS and speed <= -STATIONARY_SPEED)
+    return state
+
+
 def get_borders(dt: datetime, lat: float, lon: float):
-    builder = FlatlibBuilder()
-    formula = builder.build_formula(dt, lat=lat, lon=lon)
-    formula_id = formula.get_id()
-    left = dt - timedelta(hours=1)
-    left_formula = builder.build_formula(left, lat=lat, lon=lon)
-    while left_formula.get_id() == formula_id:
-        left -= timedelta(hours=1)
-        left_formula = builder.build_formula(left, lat=lat, lon=lon)
-    while left_formula.get_id() != formula_id:
-        left += timedelta(minutes=1)
-        left_formula = builder.build_formula(left, lat=lat, lon=lon)
-
-    right = dt + timedelta(hours=1)
-    right_formula = builder.build_formula(right, lat=lat, lon=lon)
-    while right_formula.get_id() == formula_id:
-        right += timedelta(hours=1)
-        right_formula = builder.build_formula(right, lat=lat, lon=lon)
-    while right_formula.get_id() != formula_id:
-        right -= timedelta(minutes=1)
-        right_formula = builder.build_formula(right, lat=lat, lon=lon)
-
-    return left_formula.dt, right_formula.dt
+    # от места рождения формула не зависит (в get_id не участвует Парс Фортуны), lat и lon оставлены для совместимости
+    index = get_event_index()
+    jd = dt_to_jd(dt)
+    if index is not None and index.contains(jd):
+        start_jd, end_jd = index.get_interval(jd)
+        if start_jd != index.start_jd and end_jd != index.end_jd:
+            # в индексе хранится первая минута новой формулы, значит, текущая заканчивается минутой раньше
+            minute = jd_to_minute(jd)
+            return dt + timedelta(minutes=jd_to_minute(start_jd) - minute), \
+                dt + timedelta(minutes=jd_to_minute(end_jd) - 1 - minute)
+    return _find_border(dt, -1), _find_border(dt, 1)
+
+
+def _find_border(dt: datetime, direction: int) -> datetime:
+    def state_at(minutes, planets=None):
+        return get_formula_state(dt_to_jd(dt + direction * timedelta(minutes=minutes)), planets)
+
+    start_state = state_at(0)
+
+    # ищем момент, когда формула уже другая, увеличивая шаг
+    same, step = 0, BORDER_START_STEP
+    while True:
+        changed_at = same + step
+        changed_state = state_at(changed_at)
+        if changed_state != start_state:
+            break
+        same = changed_at
+        step = min(step * 2, BORDER_MAX_STEP)
+
+    # делим отрезок пополам до минуты, пересчитывая только объекты, которые на нём сменили знак или движение
+    changed_planets = [p for p in FORMULA_ID_PLANETS if changed_state[p] != start_state[p]]
+    while changed_at - same > 1:
+        middle = (same + changed_at) // 2
+        middle_state = state_at(middle, changed_planets)
+        if all(middle_state[p] == start_state[p] for p in changed_planets):
+            same = middle
+        else:
+            changed_at = middle
+
+    return dt + direction * timedelta(minutes=same)
 
 
 if __name__ == '__main__':
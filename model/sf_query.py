@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+
+from model.sf import SoulFormulaWithBorders
+from model.sf_catalog import FormulaCatalog, CATALOG_PLANETS, CATALOG_RETRO_PLANETS, PLANET_TO_CATALOG_INDEX, \
+    get_catalog_file_name, record_to_formula
+from model.sf_events import minute_to_dt
+
+# орбита планет центра; у остальных орбита — число шагов по ссылкам до центра
+CENTER_ORBIT = 0
+
+
+# формулы по колонкам: строка — интервал, колонка — планета из CATALOG_PLANETS;
+# условия поиска записываются как выражения над колонками и считаются сразу для всех интервалов
+class FormulaTable:
+
+    def __init__(self, catalog: FormulaCatalog) -> None:
+        self.catalog = catalog
+        records = catalog.records
+        self.start = np.asarray(records['start'])
+        self.end = np.asarray(records['end'])
+        self.links = np.asarray(records['links']).astype(np.intp)
+        self.power = np.asarray(records['power']).astype(np.int16)
+
+        retro = np.asarray(records['retro'])
+        self.retro_mask = np.stack([(retro >> i) & 1 == 1 for i in range(len(CATALOG_RETRO_PLANETS))], axis=1)
+
+        # планета в центре, если по ссылкам возвращается в себя; заодно находим минимальную планету каждого цикла,
+        # чтобы посчитать число циклов в центре
+        planets = np.broadcast_to(np.arange(len(CATALOG_PLANETS)), self.links.shape)
+        cur = planets
+        self.center_mask = np.zeros(self.links.shape, dtype=bool)
+        cycle_min = planets
+        for _ in range(len(CATALOG_PLANETS)):
+            cur = np.take_along_axis(self.links, cur, axis=1)
+            self.center_mask |= cur == planets
+            cycle_min = np.minimum(cycle_min, cur)
+
+        self.orbit = np.where(self.center_mask, CENTER_ORBIT, len(CATALOG_PLANETS))
+        for _ in range(len(CATALOG_PLANETS)):
+            self.orbit = np.where(self.center_mask, CENTER_ORBIT,
+                                  np.take_along_axis(self.orbit, self.links, axis=1) + 1)
+
+        self.center_count = (self.center_mask & (cycle_min == planets)).sum(axis=1)
+        self.links_count = np.stack([(self.links == i).sum(axis=1) for i in range(len(CATALOG_PLANETS))], axis=1)
+
+    @staticmethod
+    def load(borders_file_name: str):
+        catalog_file_name = get_catalog_file_name(borders_file_name)
+        if not os.path.exists(catalog_file_name):
+            raise ValueError(f'Не найден каталог формул {catalog_file_name}, сначала постройте его (make_catalog).')
+        return FormulaTable(FormulaCatalog.load(catalog_file_name))
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def retro(self, planet: str) -> np.ndarray:
+        return self.retro_mask[:, CATALOG_RETRO_PLANETS.index(planet)]
+
+    def in_center(self, planet: str) -> np.ndarray:
+        return self.center_mask[:, PLANET_TO_CATALOG_INDEX[planet]]
+
+    def in_orbit(self, planet: str, orbit_num: int) -> np.ndarray:
+        return self.orbit[:, PLANET_TO_CATALOG_INDEX[planet]] == orbit_num
+
+    def center_size(self) -> np.ndarray:
+        return self.center_mask.sum(axis=1)
+
+    def orbit_size(self, orbit_num: int) -> np.ndarray:
+        return (self.orbit == orbit_num).sum(axis=1)
+
+    def planet_power(self, planet: str) -> np.ndarray:
+        return self.power[:, PLANET_TO_CATALOG_INDEX[planet]]
+
+    def links_to(self, planet: str, to_planet: str) -> np.ndarray:
+        return self.links[:, PLANET_TO_CATALOG_INDEX[planet]] == PLANET_TO_CATALOG_INDEX[to_planet]
+
+    def reverse_links_count(self, planet: str) -> np.ndarray:
+        return self.links_count[:, PLANET_TO_CATALOG_INDEX[planet]]
+
+    def select_intervals(self, mask: np.ndarray) -> list:
+        return [(minute_to_dt(int(self.start[i])), minute_to_dt(int(self.end[i]))) for i in np.nonzero(mask)[0]]
+
+    def select_formulas(self, mask: np.ndarray) -> [SoulFormulaWithBorders]:
+        return [record_to_formula(self.catalog.records[i]) for i in np.nonzero(mask)[0]]
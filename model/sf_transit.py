@@ -1,30 +1,37 @@
 import configparser
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from multiprocessing import Pool
 
+import numpy as np
 import pytz
 from flatlib import const
 
 from ext.sf_geocoder import DefaultSFGeocoder
 from model.sf import Cosmogram
+from model.sf_ephemeris import dates_to_jd, get_movement
+from model.sf_events import dt_to_minute, minute_to_dt, minute_to_jd, MINUTES_IN_DAY, UNIX_EPOCH_JD
 from model.sf_flatlib import FlatlibBuilder
+from model.sf_transit_table import calc_transit_planet, calc_transit_positions, TRANSIT_PLANETS
 
 
 def build_transit(cosmogram: Cosmogram, planet_to_transit: str,
                   start_date: datetime, end_date: datetime):
-    builder = FlatlibBuilder()
-    dt = start_date
-    cosmogram_cur = builder.build_cosmogram(dt)
-    start_lon = cosmogram_cur.get_planet_info(planet_to_transit).lon
+    dates = [start_date]
+    while dates[-1] < end_date:
+        dates.append(dates[-1] + timedelta(hours=6))
+    lons, _, speeds = calc_transit_positions(planet_to_transit, dates_to_jd(dates))
+
+    start_lon = lons[0]
     cur_lon = start_lon
     print(cur_lon)
 
     days_cnt = 0
     # while start_lon <= cur_lon or abs(cur_lon - start_lon) > 1 or days_cnt < 350 * 20:
-    while dt < end_date:
-        dt += timedelta(hours=6)
-        cosmogram_cur = builder.build_cosmogram(dt)
-        cur_lon = cosmogram_cur.get_planet_info(planet_to_transit).lon
+    for i in range(1, len(dates)):
+        dt = dates[i]
+        cur_lon = lons[i]
         days_cnt += 0.25
         pl = ''
         for planet in [const.SUN, const.MOON,
@@ -36,189 +43,139 @@ def build_transit(cosmogram: Cosmogram, planet_to_transit: str,
                 pl = planet_info.name + ' ' + str(round(cur_lon - planet_info.lon, 1))
 
                 dt_str = dt.strftime('%d.%m.%Y')
-                print(days_cnt, round(cur_lon, 1), cosmogram_cur.get_planet_info(planet_to_transit).movement, pl,
+                print(days_cnt, round(cur_lon, 1), get_movement(speeds[i]), pl,
                       dt_str)
         # dt_str = ''
         # if pl:
         #     dt_str = dt.strftime('%d.%m.%Y')
         #
-        # print(days_cnt, round(cur_lon, 1), cosmogram_cur.get_planet_info(planet_to_transit).movement, pl, dt_str)
+        # print(days_cnt, round(cur_lon, 1), get_movement(speeds[i]), pl, dt_str)
+
 
+_transit_pool = None
 
-def get_discrete_value(lon: float) -> int:
-    res = round(lon)
-    if res >= 360:
-        return 360 - res
-    if res < 0:
-        return 360 + res
-    return res
+
+def init_transit_pool(processes: int = None) -> None:
+    # планеты ищутся параллельно в пуле, который создаётся один раз на процесс (None — по числу ядер);
+    # без пула или при processes=1 поиск идёт последовательно
+    global _transit_pool
+    if _transit_pool is not None:
+        _transit_pool.close()
+        _transit_pool = None
+    if processes != 1:
+        _transit_pool = Pool(processes)
 
 
 def find_nearest_connections(cosmo: Cosmogram, from_date: datetime) -> {str, (str, datetime, str)}:
-    all_planets = [const.SUN, const.MOON,
-                   const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
-                   const.URANUS, const.NEPTUNE, const.PLUTO, const.CHIRON, const.NORTH_NODE,
-                   'Lilith', 'Selena']
-
-    discrete_lon_to_planets = {}
-    for planet in all_planets:
-        discrete_lon = get_discrete_value(cosmo.get_planet_info(planet).lon)
-        planets = discrete_lon_to_planets.get(discrete_lon, [])
-        if len(planets) == 0:
-            discrete_lon_to_planets[discrete_lon] = planets
-        # название планеты; направление (1 — прямое, -1 — ретроградное, 0 — уже в соединении); кол-во шагов до планеты
-        planets.append((planet, 0, 0))
-
-    for i in range(360):
-        discrete_lon = get_discrete_value(i)
-        planets = discrete_lon_to_planets.get(discrete_lon, [])
-        if len(planets) > 0:
-            continue
-        discrete_lon_to_planets[discrete_lon] = planets
-        k = i
-        ln = 0
-        while True:
-            k += 1
-            ln += 1
-            if k == 360:
-                k = 0
-
-            dv = get_discrete_value(k)
-            next_planets = [a for a in discrete_lon_to_planets.get(dv, []) if a[1] == 0]
-            if len(next_planets) > 0:
-                planets.append((next_planets[0][0], 1, ln))
-                break
-        k = i
-        ln = 0
-        while True:
-            k -= 1
-            ln += 1
-            if k == -1:
-                k = 359
-
-            dv = get_discrete_value(k)
-            next_planets = [a for a in discrete_lon_to_planets.get(dv, []) if a[1] == 0]
-            if len(next_planets) > 0:
-                planets.append((next_planets[0][0], -1, ln))
-                break
+    natal_lons = _get_natal_lons(cosmo)
+    foo = partial(_find_nearest_crossing, natal_lons=natal_lons, from_date=from_date)
+    if _transit_pool is None:
+        crossings = [foo(planet) for planet in TRANSIT_PLANETS]
+    else:
+        crossings = _transit_pool.map(foo, TRANSIT_PLANETS)
+    return dict(zip(TRANSIT_PLANETS, crossings))
 
-    builder = FlatlibBuilder()
-    result = {}
-    for planet in all_planets:
-        transit_cosmo = builder.build_cosmogram(from_date)
-        planet_discrete_lon = get_discrete_value(transit_cosmo.get_planet_info(planet).lon)
-        max_step = min([a[2] for a in discrete_lon_to_planets.get(planet_discrete_lon)])
-        td = _get_big_timedelta(planet)
-        dt = from_date + td + td * max(max_step - 2, 0)
-        p, pdt, movement = find_connection(cosmo, planet, dt)
-        result[planet] = (p, pdt, movement)
-    return result
 
+def find_nearest_crossing(cosmo: Cosmogram, planet_to_search: str, from_date: datetime) -> (str, datetime, str):
+    return _find_nearest_crossing(planet_to_search, _get_natal_lons(cosmo), from_date)
 
-def find_connection(cosmo: Cosmogram, planet_to_search: str, from_date: datetime) -> (str, datetime, str):
-    builder = FlatlibBuilder()
-    dt = from_date
+
+def _get_natal_lons(cosmo: Cosmogram) -> {str: float}:
+    return {planet: cosmo.get_planet_info(planet).lon for planet in TRANSIT_PLANETS}
+
+
+def _find_nearest_crossing(planet_to_search: str, natal_lons: {str: float}, from_date: datetime) -> (
+        str, datetime, str):
+    # ищем окнами, пока транзитная планета не пройдёт через какую-нибудь планету космограммы
+    window = _get_crossing_step(planet_to_search) * CROSSING_WINDOW_STEPS
+    from_minute = dt_to_minute(from_date)
     while True:
-        transit_cosmo = builder.build_cosmogram(dt)
-        pl1 = transit_cosmo.get_planet_info(planet_to_search).lon
-        min_planet, min_angle = None, 360
-        for planet in [const.SUN, const.MOON,
-                       const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
-                       const.URANUS, const.NEPTUNE, const.PLUTO, const.CHIRON, const.NORTH_NODE,
-                       'Lilith', 'Selena']:
-            pl2 = cosmo.get_planet_info(planet).lon
-            p_diff = abs(pl1 - pl2)
-            p_diff = min(360 - p_diff, p_diff)
-            if min_angle > p_diff:
-                min_angle = p_diff
-                min_planet = planet
-        if min_angle < 1:
-            return min_planet, find_zero_conneсtion(cosmo, planet_to_search, min_planet, dt), \
-                   transit_cosmo.get_planet_info(planet_to_search).movement
-        dt += _get_big_timedelta(planet_to_search)
-
-
-def _get_big_timedelta(planet: str) -> timedelta:
-    if planet in [const.MOON]:
-        return timedelta(hours=2)
-    if planet in [const.MERCURY]:
-        return timedelta(hours=6)
-    if planet in [const.VENUS]:
-        return timedelta(hours=15)
-    if planet in [const.SUN]:
-        return timedelta(days=1)
-    if planet in [const.MARS]:
-        return timedelta(days=2)
-    if planet in ['Selena']:
-        return timedelta(days=7)
-    if planet in ['Lilith']:
-        return timedelta(days=9)
-    if planet in [const.JUPITER]:
-        return timedelta(days=12)
-    if planet in [const.NORTH_NODE]:
-        return timedelta(days=19)
-    if planet in [const.SATURN]:
-        return timedelta(days=30)
-    if planet in [const.CHIRON]:
-        return timedelta(days=51)
-    if planet in [const.URANUS]:
-        return timedelta(days=85)
-    if planet in [const.NEPTUNE]:
-        return timedelta(days=166)
-    if planet in [const.PLUTO]:
-        return timedelta(days=251)
-    raise ValueError(f'Неизвестная планета => {planet}')
-
-
-def _get_small_timedelta(planet: str) -> timedelta:
-    if planet in [const.MOON, const.SUN, const.MERCURY, const.VENUS, const.MARS]:
-        return timedelta(hours=1)
-    if planet in [const.JUPITER, const.SATURN, const.CHIRON, const.NORTH_NODE, 'Lilith', 'Selena']:
-        return timedelta(days=1)
-    if planet in [const.URANUS, const.NEPTUNE, const.PLUTO]:
-        return timedelta(days=30)
-    raise ValueError(f'Неизвестная планета => {planet}')
-
-
-def find_zero_conneсtion(cosmo: Cosmogram, planet_to_search: str, dest_planet: str, from_date: datetime) -> (
-        str, datetime):
-    builder = FlatlibBuilder()
-    pl1 = cosmo.get_planet_info(dest_planet).lon
+        crossings = find_crossings(planet_to_search, natal_lons, from_minute, from_minute + window)
+        if crossings:
+            minute, natal_planet, movement = crossings[0]
+            return natal_planet, _minute_to_dt(minute, from_date), movement
+        from_minute += window
+
+
+# шаг сетки в минутах: за шаг планета проходит заметно меньше 180° и успевает развернуться не больше одного раза
+CROSSING_STEPS = {
+    const.MOON: MINUTES_IN_DAY // 4,
+    const.SUN: MINUTES_IN_DAY, const.MERCURY: MINUTES_IN_DAY, const.VENUS: MINUTES_IN_DAY, const.MARS: MINUTES_IN_DAY
+}
+CROSSING_WINDOW_STEPS = 400
+
+
+def _get_crossing_step(planet: str) -> int:
+    return CROSSING_STEPS.get(planet, 5 * MINUTES_IN_DAY)
+
+
+def find_crossings(planet_to_search: str, natal_lons: {str: float},
+                   from_minute: int, to_minute: int) -> [(int, str, str)]:
+    # все моменты из [from_minute; to_minute], когда долгота транзитной планеты равна долготе одной из natal_lons:
+    # (минута, планета космограммы, движение транзитной планеты), по возрастанию времени
+    step = _get_crossing_step(planet_to_search)
+    minutes = np.arange(from_minute, to_minute + 1, step, dtype=np.int64)
+    if minutes[-1] != to_minute:
+        minutes = np.append(minutes, to_minute)
+    lons, _, speeds = calc_transit_positions(planet_to_search, UNIX_EPOCH_JD + minutes / MINUTES_IN_DAY)
+    retro = speeds < 0
+
+    # в точках разворота планеты сетка дополняется, чтобы между соседними точками долгота менялась монотонно
+    stations = [_find_station_minute(planet_to_search, int(minutes[i]), int(minutes[i + 1]), bool(retro[i]))
+                for i in np.nonzero(retro[1:] != retro[:-1])[0]]
+    if stations:
+        minutes = np.sort(np.concatenate([minutes, stations]))
+        lons, _, _ = calc_transit_positions(planet_to_search, UNIX_EPOCH_JD + minutes / MINUTES_IN_DAY)
+
+    natal_planets = list(natal_lons.keys())
+    targets = np.array([natal_lons[p] for p in natal_planets])
+    diffs = _get_lon_diff(lons[:, np.newaxis], targets[np.newaxis, :])
+    d1, d2 = diffs[:-1], diffs[1:]
+    crossed = ((d1 < 0) & (d2 >= 0) | (d1 > 0) & (d2 <= 0)) & (np.abs(d2 - d1) < 180)
+
+    result = []
+    for i, k in zip(*np.nonzero(crossed)):
+        minute = _find_crossing_minute(planet_to_search, targets[k], int(minutes[i]), int(minutes[i + 1]),
+                                       d1[i, k] < 0)
+        _, _, speed = calc_transit_planet(planet_to_search, minute_to_jd(minute))
+        result.append((minute, natal_planets[k], get_movement(speed)))
+    result.sort(key=lambda a: a[0])
+    return result
 
-    td = _get_small_timedelta(planet_to_search)
 
-    left = from_date + td
-    right = from_date - td
-    cosmo_l = builder.build_cosmogram(left)
-    cosmo_r = builder.build_cosmogram(right)
-    pll = cosmo_l.get_planet_info(planet_to_search).lon
-    plr = cosmo_r.get_planet_info(planet_to_search).lon
+def _get_lon_diff(lon, target):
+    # разность долгот в [-180; 180)
+    return (lon - target + 180) % 360 - 180
 
-    p_diffl = abs(pl1 - pll)
-    p_diffl = min(360 - p_diffl, p_diffl)
 
-    p_diffr = abs(pl1 - plr)
-    p_diffr = min(360 - p_diffr, p_diffr)
+def _find_station_minute(planet: str, from_minute: int, to_minute: int, from_retro: bool) -> int:
+    while to_minute - from_minute > 1:
+        middle = (from_minute + to_minute) // 2
+        _, _, speed = calc_transit_planet(planet, minute_to_jd(middle))
+        if (speed < 0) == from_retro:
+            from_minute = middle
+        else:
+            to_minute = middle
+    return to_minute
+
+
+def _find_crossing_minute(planet: str, target: float, from_minute: int, to_minute: int, from_below: bool) -> int:
+    # первая минута, в которую планета уже дошла до target
+    while to_minute - from_minute > 1:
+        middle = (from_minute + to_minute) // 2
+        lon, _, _ = calc_transit_planet(planet, minute_to_jd(middle))
+        if (_get_lon_diff(lon, target) < 0) == from_below:
+            from_minute = middle
+        else:
+            to_minute = middle
+    return to_minute
 
-    if p_diffl < p_diffr:
-        k = 1
-        p_diff = p_diffl
-        prev_diff = p_diffr
-        dt = left
-    else:
-        k = -1
-        p_diff = p_diffr
-        prev_diff = p_diffl
-        dt = right
 
-    while prev_diff > p_diff:
-        dt += k * td
-        cosmo_t = builder.build_cosmogram(dt)
-        prev_diff = p_diff
-        l = cosmo_t.get_planet_info(planet_to_search).lon
-        p_diff = abs(pl1 - l)
-        p_diff = min(360 - p_diff, p_diff)
-    return dt - k * td
+def _minute_to_dt(minute: int, like_dt: datetime) -> datetime:
+    dt = minute_to_dt(minute)
+    if like_dt.tzinfo is None:
+        return dt
+    return dt.replace(tzinfo=timezone.utc).astimezone(like_dt.tzinfo)
 
 
 if __name__ == '__main__':
@@ -253,19 +210,6 @@ if __name__ == '__main__':
 
     ts0 = time.time()
     planet_to_nearest_connection = find_nearest_connections(cosmogram, cur_dt)
-    print(f'Общее время нового алгоритма {round(time.time() - ts0, 1)} сек')
-
-    ts = time.time()
-    for p in [const.SUN, const.MOON,
-              const.MERCURY, const.VENUS, const.MARS, const.JUPITER, const.SATURN,
-              const.URANUS, const.NEPTUNE, const.PLUTO, const.CHIRON, const.NORTH_NODE,
-              'Lilith', 'Selena']:
-        t1 = time.time()
-        planet, dt = find_connection(cosmogram, p, cur_dt)
-        tdiff = time.time() - t1
-        print(f'{p} <-> {planet} ({round(tdiff, 1)} cек)')
-        print(dt.strftime('%d.%m.%Y %H:%M'))
-        planet1, dt1 = planet_to_nearest_connection.get(p)
-        print(dt1.strftime('%d.%m.%Y %H:%M') + ' ' + planet1)
-        print()
-    print(f'Общее время {round(time.time() - ts, 1)} сек')
+    print(f'Общее время {round(time.time() - ts0, 1)} сек')
+    for p, (planet, dt, movement) in planet_to_nearest_connection.items():
+        print(f'{p} <-> {planet} ({movement}): {dt.strftime("%d.%m.%Y %H:%M")}')
@@ -0,0 +1,165 @@
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from model.sf_ephemeris import calc_ephemeris, calc_planet_cached, dt_to_jd, BATCH_PLANETS, STATIONARY_SPEED
+
+TRANSIT_TABLE_FILE = 'data/transit_table.bin'
+TRANSIT_TABLE_YEARS = 30
+# как часто (в секундах) проверять, не подменён ли файл таблицы
+TRANSIT_TABLE_CHECK_INTERVAL = 60
+
+# шаг таблицы в сутках; между узлами долгота восстанавливается кубическим сплайном Эрмита по долготе и скорости;
+# обычно ошибка — сотые доли угловой секунды по долготе и до 1e-4 градуса в сутки по скорости (Луна), но на
+# стыках отрезков самого swisseph у медленных планет она доходит до 3 угловых секунд и 0.013 градуса в сутки
+TRANSIT_TABLE_STEP = 0.25
+# рядом со стоянием ошибка скорости может поменять направление движения, поэтому там, где скорость по таблице
+# ближе к порогу стояния, чем на этот запас, положение считается напрямую
+TRANSIT_STATION_MARGIN = 0.02
+
+TRANSIT_PLANETS = BATCH_PLANETS
+TRANSIT_DTYPE = np.dtype([('jd', '<f8'),
+                          ('lon', '<f8', (len(TRANSIT_PLANETS),)),
+                          ('lat', '<f8', (len(TRANSIT_PLANETS),)),
+                          ('speed', '<f8', (len(TRANSIT_PLANETS),))])
+
+
+# положения транзитных объектов на равномерной сетке юлианских дней; файл отображается в память,
+# поэтому все процессы веб-приложения читают одну и ту же копию
+class TransitTable:
+
+    def __init__(self, rows: np.ndarray) -> None:
+        self.rows = rows
+        self.start_jd = float(rows['jd'][0])
+        self.end_jd = float(rows['jd'][-1])
+        self.step = float(rows['jd'][1] - rows['jd'][0])
+        self.planet_to_index = {planet: i for i, planet in enumerate(TRANSIT_PLANETS)}
+
+    @staticmethod
+    def load(file_name: str = TRANSIT_TABLE_FILE):
+        return TransitTable(np.memmap(file_name, dtype=TRANSIT_DTYPE, mode='r'))
+
+    def save(self, file_name: str = TRANSIT_TABLE_FILE) -> None:
+        # файл подменяется целиком: процессы, которые уже отобразили старый, дочитывают его без ошибок
+        self.rows.tofile(file_name + '.tmp')
+        os.replace(file_name + '.tmp', file_name)
+
+    def contains(self, jd) -> bool:
+        return self.start_jd <= np.min(jd) and np.max(jd) < self.end_jd
+
+    def get_positions(self, planet: str, jd: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+        j = self.planet_to_index[planet]
+        jd = np.asarray(jd, dtype=np.float64)
+        i = ((jd - self.start_jd) // self.step).astype(np.int64)
+        t = (jd - self.start_jd) / self.step - i
+
+        lon0 = self.rows['lon'][i, j]
+        lon_diff = (self.rows['lon'][i + 1, j] - lon0 + 180) % 360 - 180
+        m0 = self.rows['speed'][i, j] * self.step
+        m1 = self.rows['speed'][i + 1, j] * self.step
+
+        t2 = t * t
+        t3 = t2 * t
+        lon = lon0 + (t3 - 2 * t2 + t) * m0 + (-2 * t3 + 3 * t2) * lon_diff + (t3 - t2) * m1
+        speed = ((3 * t2 - 4 * t + 1) * m0 + (-6 * t2 + 6 * t) * lon_diff + (3 * t2 - 2 * t) * m1) / self.step
+        lat = self.rows['lat'][i, j] * (1 - t) + self.rows['lat'][i + 1, j] * t
+        return lon % 360, lat, speed
+
+    def get_position(self, planet: str, jd: float) -> (float, float, float):
+        lon, lat, speed = self.get_positions(planet, np.array([jd]))
+        return float(lon[0]), float(lat[0]), float(speed[0])
+
+
+def build_transit_table(from_jd: float, to_jd: float, step: float = TRANSIT_TABLE_STEP,
+                        old_table: TransitTable = None) -> TransitTable:
+    jd = from_jd + np.arange(int(np.ceil((to_jd - from_jd) / step)) + 1) * step
+    rows = np.zeros(len(jd), dtype=TRANSIT_DTYPE)
+    rows['jd'] = jd
+
+    # узлы, которые уже есть в старой таблице (та же сетка), переносятся без пересчёта
+    to_calc = np.ones(len(jd), dtype=bool)
+    if old_table is not None and old_table.step == step:
+        old_i = np.round((jd - old_table.start_jd) / step).astype(np.int64)
+        same = (old_i >= 0) & (old_i < len(old_table.rows))
+        same[same] = old_table.rows['jd'][old_i[same]] == jd[same]
+        rows[same] = old_table.rows[old_i[same]]
+        to_calc = ~same
+
+    if np.any(to_calc):
+        table = calc_ephemeris(jd[to_calc], TRANSIT_PLANETS)
+        rows['lon'][to_calc] = table.lon
+        rows['lat'][to_calc] = table.lat
+        rows['speed'][to_calc] = table.speed
+    return TransitTable(rows)
+
+
+def update_transit_table(file_name: str = TRANSIT_TABLE_FILE, years: int = TRANSIT_TABLE_YEARS,
+                         cur_time: datetime = None) -> TransitTable:
+    # скользящее окно ±years лет от текущей даты; запускается периодически (например, раз в сутки по cron)
+    cur_time = datetime.utcnow() if cur_time is None else cur_time
+    from_jd = np.floor(dt_to_jd(cur_time.replace(year=cur_time.year - years, month=1, day=1))) + 0.5
+    to_jd = np.floor(dt_to_jd(cur_time.replace(year=cur_time.year + years, month=12, day=31))) + 0.5
+    old_table = TransitTable.load(file_name) if os.path.exists(file_name) else None
+    table = build_transit_table(from_jd, to_jd, old_table=old_table)
+    table.save(file_name)
+    return table
+
+
+_table = None
+_table_mtime = None
+_table_check_time = None
+
+
+def get_transit_table(file_name: str = TRANSIT_TABLE_FILE):
+    # таблица перечитывается, когда фоновое обновление подменило файл, но файл проверяется не чаще, чем раз
+    # в TRANSIT_TABLE_CHECK_INTERVAL секунд; если файла нет, возвращается None
+    global _table, _table_mtime, _table_check_time
+    cur_time = time.time()
+    if _table_check_time is not None and cur_time - _table_check_time < TRANSIT_TABLE_CHECK_INTERVAL:
+        return _table
+    _table_check_time = cur_time
+    mtime = os.stat(file_name).st_mtime if os.path.exists(file_name) else None
+    if mtime is None:
+        _table = None
+    elif _table is None or mtime != _table_mtime:
+        _table = TransitTable.load(file_name)
+    _table_mtime = mtime
+    return _table
+
+
+def _is_near_station(speed):
+    return np.abs(speed) < STATIONARY_SPEED + TRANSIT_STATION_MARGIN
+
+
+def calc_transit_planet(planet: str, jd: float) -> (float, float, float):
+    table = get_transit_table()
+    if table is not None and table.contains(jd):
+        position = table.get_position(planet, jd)
+        if not _is_near_station(position[2]):
+            return position
+    return calc_planet_cached(planet, jd)
+
+
+def calc_transit_positions(planet: str, jd: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    table = get_transit_table()
+    if table is not None and table.contains(jd):
+        lon, lat, speed = table.get_positions(planet, jd)
+        # точки рядом со стоянием пересчитываются напрямую
+        near_station = _is_near_station(speed)
+        if np.any(near_station):
+            ephemeris = calc_ephemeris(np.asarray(jd, dtype=np.float64)[near_station], [planet])
+            lon[near_station] = ephemeris.get_lon(planet)
+            lat[near_station] = ephemeris.lat[:, 0]
+            speed[near_station] = ephemeris.get_speed(planet)
+        return lon, lat, speed
+    ephemeris = calc_ephemeris(jd, [planet])
+    return ephemeris.get_lon(planet), ephemeris.lat[:, 0], ephemeris.get_speed(planet)
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    transit_table = update_transit_table()
+    final_time_spend = time.time() - start_time
+    print(f'Таблица транзитов на {len(transit_table.rows)} узлов обновлена за {round(final_time_spend)} сек')
@@ -0,0 +1,255 @@
+import math
+import time
+from abc import abstractmethod
+
+import numpy as np
+
+
+# во что обошлась оптимизация: итерации, вычисления функции и градиента, время и значение функции до и после;
+# для раскладки формулы счётчики и время складываются по всем вариантам поворотов центров, а значения берутся
+# у выбранного варианта
+class OptimizationReport:
+
+    def __init__(self, iterations: int = 0, function_evaluations: int = 0, gradient_evaluations: int = 0,
+                 time_spend: float = 0.0, start_value: float = 0.0, value: float = 0.0) -> None:
+        self.iterations = iterations
+        self.function_evaluations = function_evaluations
+        self.gradient_evaluations = gradient_evaluations
+        self.time_spend = time_spend
+        self.start_value = start_value
+        self.value = value
+
+    def add(self, other) -> None:
+        self.iterations += other.iterations
+        self.function_evaluations += other.function_evaluations
+        self.gradient_evaluations += other.gradient_evaluations
+        self.time_spend += other.time_spend
+
+    def __str__(self) -> str:
+        return f'итераций {self.iterations}, вычислений функции {self.function_evaluations}, ' \
+               f'градиента {self.gradient_evaluations}, {round(self.time_spend, 3)} сек, ' \
+               f'значение {round(self.start_value, 6)} → {round(self.value, 6)}'
+
+
+# минимизируемая функция от плоского вектора углов и её градиент;
+# log_iteration вызывается после каждой итерации, чтобы можно было посмотреть на промежуточные раскладки
+class AnglesProblem:
+
+    @abstractmethod
+    def value(self, x: np.ndarray) -> float:
+        pass
+
+    @abstractmethod
+    def gradient(self, x: np.ndarray) -> np.ndarray:
+        pass
+
+    def log_iteration(self, x: np.ndarray, value: float, success: bool, step: float) -> None:
+        pass
+
+
+# считает вычисления функции и градиента для отчёта
+class _CountedProblem(AnglesProblem):
+
+    def __init__(self, problem: AnglesProblem, report: OptimizationReport) -> None:
+        self.problem = problem
+        self.report = report
+
+    def value(self, x: np.ndarray) -> float:
+        self.report.function_evaluations += 1
+        return self.problem.value(x)
+
+    def gradient(self, x: np.ndarray) -> np.ndarray:
+        self.report.gradient_evaluations += 1
+        return self.problem.gradient(x)
+
+    def log_iteration(self, x: np.ndarray, value: float, success: bool, step: float) -> None:
+        self.problem.log_iteration(x, value, success, step)
+
+
+class AnglesOptimizer:
+    # шаг засчитывается, только если функция уменьшилась больше, чем на min_improvement
+    min_improvement = 0.00001
+
+    def minimize(self, problem: AnglesProblem, x: np.ndarray) -> (np.ndarray, OptimizationReport):
+        start_time = time.time()
+        report = OptimizationReport()
+        x, report.start_value, report.value, report.iterations = \
+            self._minimize(_CountedProblem(problem, report), np.asarray(x, dtype=np.float64).copy())
+        report.time_spend = time.time() - start_time
+        return x, report
+
+    # возвращает найденную точку, значение функции в начале и в ней, число итераций
+    @abstractmethod
+    def _minimize(self, problem: AnglesProblem, x: np.ndarray) -> (np.ndarray, float, float, int):
+        pass
+
+    def _is_success_step(self, cur_value: float, prev_value: float) -> bool:
+        return cur_value < prev_value and abs(cur_value - prev_value) > self.min_improvement
+
+
+# прежний способ (только градиент теперь точный): шаг вдоль нормированного антиградиента, начиная с 30 градусов;
+# после неудачного шага он уменьшается вдвое, пока не станет меньше 0.5 градуса; при небольшом шаге, если не удалось
+# сдвинуть все планеты сразу, пробуем сдвинуть каждую по отдельности
+class StepHalvingAnglesOptimizer(AnglesOptimizer):
+    step_min = 0.5 * math.pi / 180
+    step_max = 30.0 * math.pi / 180
+    step_by_one_max = 10.0 * math.pi / 180
+    max_iterations = 100
+
+    def _minimize(self, problem: AnglesProblem, x: np.ndarray) -> (np.ndarray, float, float, int):
+        step = self.step_max
+        value = problem.value(x)
+        start_value = value
+        problem.log_iteration(x, value, True, step)
+
+        is_success = False
+        iterations = 0
+        while (step > self.step_min or is_success) and iterations < self.max_iterations:
+            iterations += 1
+
+            gradient = problem.gradient(x)
+            gradient_len = np.linalg.norm(gradient)
+            if gradient_len != 0:
+                gradient = gradient / gradient_len
+            new_x, new_value = self._move_by_gradient(problem, x, value, gradient, step)
+
+            is_success = self._is_success_step(new_value, value)
+            problem.log_iteration(new_x, new_value, is_success, step)
+            if is_success:
+                x, value = new_x, new_value
+            elif step > self.step_min:
+                step /= 2
+
+        return x, start_value, value, iterations
+
+    def _move_by_gradient(self, problem: AnglesProblem, x: np.ndarray, value: float, gradient: np.ndarray,
+                          step: float) -> (np.ndarray, float):
+        new_x = x - step * gradient
+        new_value = problem.value(new_x)
+        if self._is_success_step(new_value, value) or step > self.step_by_one_max:
+            return new_x, new_value
+
+        # каждый сдвиг добавляется к уже удавшимся, но сравнивается с исходным значением
+        by_one_x, by_one_value, success = x.copy(), value, False
+        for i in range(len(x)):
+            cur_x = by_one_x.copy()
+            cur_x[i] = x[i] - step * gradient[i]
+            cur_value = problem.value(cur_x)
+            if self._is_success_step(cur_value, value):
+                by_one_x, by_one_value, success = cur_x, cur_value, True
+        if not success:
+            return new_x, new_value
+        return by_one_x, by_one_value
+
+
+# L-BFGS: направление из последних memory пар (сдвиг, изменение градиента), длина шага — дроблением, пока
+# не выполнено условие Армихо; ни одна планета за шаг не сдвигается больше, чем на step_max, потому что
+# штраф за сближение планет растёт экспоненциально и градиент в начале бывает огромным
+class LBFGSAnglesOptimizer(AnglesOptimizer):
+    memory = 7
+    step_min = 0.01 * math.pi / 180
+    step_max = 30.0 * math.pi / 180
+    armijo = 0.0001
+    max_iterations = 100
+
+    def _minimize(self, problem: AnglesProblem, x: np.ndarray) -> (np.ndarray, float, float, int):
+        value = problem.value(x)
+        start_value = value
+        problem.log_iteration(x, value, True, self.step_max)
+        if len(x) == 0:
+            return x, start_value, value, 0
+
+        gradient = problem.gradient(x)
+        s_list, y_list = [], []
+        iterations = 0
+        while iterations < self.max_iterations:
+            iterations += 1
+
+            direction = self._get_direction(gradient, s_list, y_list)
+            slope = direction @ gradient
+            if slope >= 0:
+                s_list, y_list = [], []
+                direction = -gradient
+                slope = direction @ gradient
+            from_gradient = not s_list
+            max_move = np.max(np.abs(direction))
+            if max_move == 0:
+                break
+
+            step = min(1.0, self.step_max / max_move)
+            new_x, new_value = self._search_step(problem, x, value, direction, slope, step, max_move)
+            is_success = new_x is not None and self._is_success_step(new_value, value)
+            if new_x is not None:
+                new_gradient = problem.gradient(new_x)
+                s, y = new_x - x, new_gradient - gradient
+                if s @ y > 1e-12:
+                    s_list.append(s)
+                    y_list.append(y)
+                    if len(s_list) > self.memory:
+                        s_list.pop(0)
+                        y_list.pop(0)
+                x, value, gradient = new_x, new_value, new_gradient
+            if not is_success:
+                # заметно уменьшить функцию не удалось: если шли по накопленной кривизне, она могла устареть,
+                # и пробуем ещё раз с антиградиента, а если уже шли по антиградиенту — останавливаемся
+                if from_gradient:
+                    break
+                s_list, y_list = [], []
+
+        return x, start_value, value, iterations
+
+    def _search_step(self, problem: AnglesProblem, x: np.ndarray, value: float, direction: np.ndarray,
+                     slope: float, step: float, max_move: float) -> (np.ndarray, float):
+        # дробим шаг, пока не выполнено условие Армихо; если шаг стал меньше step_min, возвращаем None
+        while step * max_move >= self.step_min:
+            new_x = x + step * direction
+            new_value = problem.value(new_x)
+            success = new_value <= value + self.armijo * step * slope
+            problem.log_iteration(new_x, new_value, success, step * max_move)
+            if success:
+                return new_x, new_value
+            step /= 2
+        return None, None
+
+    @staticmethod
+    def _get_direction(gradient: np.ndarray, s_list: [np.ndarray], y_list: [np.ndarray]) -> np.ndarray:
+        q = gradient.copy()
+        alphas = []
+        for s, y in zip(reversed(s_list), reversed(y_list)):
+            alpha = (s @ q) / (s @ y)
+            q -= alpha * y
+            alphas.append(alpha)
+        if s_list:
+            q *= (s_list[-1] @ y_list[-1]) / (y_list[-1] @ y_list[-1])
+        for (s, y), alpha in zip(zip(s_list, y_list), reversed(alphas)):
+            beta = (y @ q) / (s @ y)
+            q += (alpha - beta) * s
+        return -q
+
+
+if __name__ == '__main__':
+    from model.sf_catalog import FormulaCatalog, get_catalog_file_name
+    from view.sf_layout_angles import AnglesLayoutMaker, ReportOptimizationLogger, CircleCutPolicy
+
+    # сравнение оптимизаторов на разных по структуре формулах из каталога: отчёт о сходимости по каждой формуле
+    # и суммарно — итерации, вычисления функции и градиента, время, значение функции у выбранного варианта
+    formulas_cnt = 200
+    catalog = FormulaCatalog.load(get_catalog_file_name('data/borders_1900_2100.csv'))
+    formulas = {}
+    for formula in catalog.iterate_formulas():
+        formulas.setdefault(formula.formula.get_key(), formula.formula)
+        if len(formulas) >= formulas_cnt:
+            break
+
+    for optimizer in [StepHalvingAnglesOptimizer(), LBFGSAnglesOptimizer()]:
+        logger = ReportOptimizationLogger(verbose=True)
+        layout_maker = AnglesLayoutMaker(logger, optimizer=optimizer)
+        for formula in formulas.values():
+            layout_maker.make_layout_data(formula, CircleCutPolicy(1.0))
+
+        total = OptimizationReport()
+        for _, report in logger.reports:
+            total.add(report)
+            total.value += report.value
+            total.start_value += report.start_value
+        print(f'{type(optimizer).__name__} на {len(formulas)} формулах: {total}')
@@ -1,15 +1,20 @@
+import copy
 import itertools
 import math
+import os
 import shutil
 from abc import abstractmethod
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 from typing import List
 
 import cairo
+import numpy as np
 
 from model.sf import SoulFormula
 from model.sf_flatlib import FlatlibBuilder
+from view.sf_angles_optimization import AnglesOptimizer, AnglesProblem, LBFGSAnglesOptimizer, OptimizationReport
 from view.sf_cairo import DFormula, SimpleFormulaDrawer, CirclePosition, OrbitPosition
 from view.sf_geometry import rotate_point
 from view.sf_layout import LayoutMaker, save_formula_to_pdf, FormulaCutter
@@ -115,6 +120,38 @@ class CFormula:
         res._orbit_label_angles = self._orbit_label_angles.copy()
         return res
 
+    def to_dict(self) -> dict:
+        # снимок раскладки для кэша: только числа и списки, чтобы сохранять в JSON
+        return {
+            'formula_center': [list(center) for center in self.soul_formula.center],
+            'planet_radius': self.planet_radius,
+            'orbit_width': self.orbit_width,
+            'orbit_label_ratio': self.orbit_label_ratio,
+            'x0': self._x0,
+            'y0': self._y0,
+            'compression_ratio': [self._compression_ratio_x, self._compression_ratio_y],
+            'centers': [list(center) for center in self._centers],
+            'center_coordinates': [[cc.x, cc.y, cc.r] for cc in self._center_coordinates],
+            'center_radius': self._center_radius,
+            'planet_to_angle': dict(self._planet_to_angle),
+            'orbit_label_angles': list(self._orbit_label_angles)
+        }
+
+    @staticmethod
+    def from_dict(soul_formula: SoulFormula, data: dict):
+        # формула та же по структуре, но с датой, ретроградностью и силой планет из soul_formula
+        formula = soul_formula.copy()
+        formula.center = [list(center) for center in data['formula_center']]
+        res = CFormula(formula, data['planet_radius'], data['orbit_width'], data['orbit_label_ratio'])
+        res._x0, res._y0 = data['x0'], data['y0']
+        res._compression_ratio_x, res._compression_ratio_y = data['compression_ratio']
+        res.set_centers([list(center) for center in data['centers']])
+        res._center_coordinates = [CircleCoordinates(x, y, r) for x, y, r in data['center_coordinates']]
+        res._center_radius = data['center_radius']
+        res._planet_to_angle = dict(data['planet_to_angle'])
+        res._orbit_label_angles = list(data['orbit_label_angles'])
+        return res
+
     def set_center_circle_radius(self, r: float) -> None:
         self._center_radius = r
 
@@ -242,6 +279,10 @@ class OptimizationLogger:
     def start_new_optimization(self, op_type: str) -> None:
         pass
 
+    # отчёт о сходимости по формуле целиком, после того как посчитаны все варианты поворотов центров
+    def log_report(self, soul_formula: SoulFormula, report: OptimizationReport) -> None:
+        pass
+
 
 class NothingOptimizationLogger(OptimizationLogger):
 
@@ -249,6 +290,25 @@ class NothingOptimizationLogger(OptimizationLogger):
         pass
 
 
+# копит отчёты о сходимости по формулам, промежуточные итерации не сохраняет
+class ReportOptimizationLogger(OptimizationLogger):
+
+    def __init__(self, verbose: bool = False) -> None:
+        self.verbose = verbose
+        self.reports = []
+
+    def log_iteration(self, c_formula: CFormula, add_info: {str, str}) -> None:
+        pass
+
+    def start_new_optimization(self, op_type: str) -> None:
+        pass
+
+    def log_report(self, soul_formula: SoulFormula, report: OptimizationReport) -> None:
+        self.reports.append((soul_formula, report))
+        if self.verbose:
+            print(f'{soul_formula.get_id()}: {report}')
+
+
 class PDFOptimizationLogger(OptimizationLogger):
 
     def log_iteration(self, c_formula: CFormula, add_info: {}) -> None:
@@ -339,12 +399,21 @@ class CutPolicy:
     def cut_formula(self, c_formula: CFormula) -> CFormula:
         pass
 
+    @abstractmethod
+    def get_layout_params(self) -> tuple:
+        # параметры, от которых зависит выбор лучшей раскладки; масштаб в них не входит,
+        # поэтому одна запись кэша раскладок годится для картинок любого размера
+        pass
+
 
 class NothingCutPolicy(CutPolicy):
 
     def cut_formula(self, c_formula: CFormula) -> CFormula:
         return c_formula
 
+    def get_layout_params(self) -> tuple:
+        return 'nothing',
+
 
 class RectangleCutPolicy(CutPolicy):
 
@@ -362,6 +431,9 @@ class RectangleCutPolicy(CutPolicy):
 
         return c_formula
 
+    def get_layout_params(self) -> tuple:
+        return 'rectangle', round(self.width / self.height, 6)
+
     @staticmethod
     def _get_bounds(c_formula: CFormula, length_ratio=1.0, space_ratio=0.05):
         width, height = c_formula.get_bounds()
@@ -409,6 +481,9 @@ class CircleCutPolicy(CutPolicy):
         c_formula.move_coordinates(-min_x / xk, -min_y / yk, scale)
         return c_formula
 
+    def get_layout_params(self) -> tuple:
+        return 'circle', self.padding
+
     @staticmethod
     def _get_min_circle(c_formula: CFormula) -> (float, float, float):
         circles: [CirclePosition] = []
@@ -440,34 +515,88 @@ class AnglesLayoutMaker(LayoutMaker):
     orbit_width = 50
     center_single_radius = 25
 
-    def __init__(self, logger: OptimizationLogger = NothingOptimizationLogger()) -> None:
+    # layout_cache — кэш раскладок (view.sf_layout_cache.LayoutCache); без него раскладка считается каждый раз;
+    # executor — пул процессов (multiprocessing.Pool или concurrent.futures.Executor), в котором варианты поворотов
+    # центров оптимизируются по executor_batch штук сразу; без него — по одному в текущем процессе;
+    # optimizer — чем подбирать углы планет на орбитах (view.sf_angles_optimization), по умолчанию L-BFGS
+    def __init__(self, logger: OptimizationLogger = NothingOptimizationLogger(), layout_cache=None,
+                 executor=None, executor_batch: int = None, optimizer: AnglesOptimizer = None) -> None:
         self.logger = logger
+        self.layout_cache = layout_cache
+        self.executor = executor
+        self.executor_batch = executor_batch if executor_batch else os.cpu_count()
+        self.optimizer = optimizer if optimizer else LBFGSAnglesOptimizer()
 
     def make_layout(self, soul_formula: SoulFormula, width: int, height: int,
                     cut_policy: CutPolicy = NothingCutPolicy()) -> DFormula:
-
-        best_formula = None
-        for formula in self._generate_all_formulas(soul_formula):
-            c_formula = self.make_start_layout(formula)
-
-            self.logger.start_new_optimization('zero_a')
-            c_formula = self._optimize_to_zero_angles(c_formula, self._get_alpha0_composite)
-
-            c_formula = self._place_orbit_labels(c_formula)
-
-            c_formula.compress()
-            c_formula = cut_policy.cut_formula(c_formula)
-
-            if not best_formula or c_formula.planet_radius > best_formula.planet_radius:
-                best_formula = c_formula
-
-        return convert_cformula_to_dformula(best_formula)
+        layout = None
+        if self.layout_cache is not None:
+            key = self.layout_cache.make_key(soul_formula, self.get_layout_params(cut_policy))
+            layout = self.layout_cache.get(key)
+            if layout is None:
+                layout = self.make_layout_data(soul_formula, cut_policy)
+                self.layout_cache.put(key, layout)
+        else:
+            layout = self.make_layout_data(soul_formula, cut_policy)
+
+        # обрезка дешёвая, поэтому в кэше хранится раскладка до неё, а масштаб применяется на каждый вызов
+        c_formula = cut_policy.cut_formula(CFormula.from_dict(soul_formula, layout))
+        return convert_cformula_to_dformula(c_formula)
+
+    def get_layout_params(self, cut_policy: CutPolicy) -> tuple:
+        return (AnglesLayoutMaker.planet_radius, AnglesLayoutMaker.center_padding,
+                AnglesLayoutMaker.orbit_width, AnglesLayoutMaker.center_single_radius,
+                type(self.optimizer).__name__) + cut_policy.get_layout_params()
+
+    def make_layout_data(self, soul_formula: SoulFormula, cut_policy: CutPolicy = NothingCutPolicy()) -> dict:
+        # раскладка зависит только от структуры формулы, поэтому результат — снимок CFormula до обрезки;
+        # при равных радиусах, как и раньше, побеждает вариант, который раньше в _generate_all_formulas
+        formulas = self._generate_all_formulas(soul_formula)
+        if self.executor is None:
+            map_foo, batch_size, maker = map, 1, self
+        else:
+            map_foo, batch_size = self.executor.map, self.executor_batch
+            # в другие процессы уходит копия без логгера, кэша и пула: их не всегда можно передать
+            maker = copy.copy(self)
+            maker.logger, maker.layout_cache, maker.executor = NothingOptimizationLogger(), None, None
+
+        best_radius, best_layout, best_report = None, None, None
+        report = OptimizationReport()
+        for pos in range(0, len(formulas), batch_size):
+            results = map_foo(partial(_make_candidate_layout, maker=maker, cut_policy=cut_policy),
+                              formulas[pos:pos + batch_size])
+            for planet_radius, layout, candidate_report in results:
+                report.add(candidate_report)
+                if best_radius is None or planet_radius > best_radius:
+                    best_radius, best_layout, best_report = planet_radius, layout, candidate_report
+
+        report.start_value, report.value = best_report.start_value, best_report.value
+        self.logger.log_report(soul_formula, report)
+        return best_layout
+
+    def make_candidate_layout(self, formula: SoulFormula, cut_policy: CutPolicy) -> (float, dict, OptimizationReport):
+        c_formula = self.make_start_layout(formula)
+
+        self.logger.start_new_optimization('zero_a')
+        c_formula, report = self._optimize_to_zero_angles(c_formula, self._get_alpha0_composite)
+
+        c_formula = self._place_orbit_labels(c_formula)
+
+        c_formula.compress()
+        layout = c_formula.to_dict()
+        c_formula = cut_policy.cut_formula(c_formula)
+        return c_formula.planet_radius, layout, report
 
     @staticmethod
     def _generate_all_formulas(formula: SoulFormula) -> [SoulFormula]:
         centers = sorted(formula.center, key=lambda a: len(a))
         formula.center = centers
-        center_sizes = [[i for i in range(0, len(a))] for a in formula.center]
+        # если ни одна планета с орбит не ссылается на планеты центра, все его повороты дают одну и ту же раскладку:
+        # планеты центра занимают те же вершины многоугольника, меняются только подписи, а планеты на орбитах
+        # ни от одной из них не зависят; поэтому такой центр не поворачиваем — остаётся вариант с меньшим номером,
+        # который и так выигрывал при равных радиусах
+        center_sizes = [[i for i in range(0, len(a))] if AnglesLayoutMaker._is_linked_from_orbits(formula, a) else [0]
+                        for a in formula.center]
         res = []
         for idx in itertools.product(*center_sizes):
             new_centers = []
@@ -481,6 +610,14 @@ class AnglesLayoutMaker(LayoutMaker):
             res.append(new_formula)
         return res
 
+    @staticmethod
+    def _is_linked_from_orbits(formula: SoulFormula, center: [str]) -> bool:
+        for planet in center:
+            for from_planet in formula.reverse_links.get(planet, []):
+                if from_planet not in formula.center_set:
+                    return True
+        return False
+
     def _place_orbit_labels(self, c_formula: CFormula) -> CFormula:
         if len(c_formula.soul_formula.orbits) == 0:
             return c_formula
@@ -515,57 +652,11 @@ class AnglesLayoutMaker(LayoutMaker):
 
         return -1
 
-    def _optimize_to_zero_angles(self, c_formula: CFormula, target_angle_function) -> CFormula:
-        # исходный шаг 30 градусов, минимальный — 1 градус
-        step_min = 0.5 * math.pi / 180
-        step_max = 30.0 * math.pi / 180
-        step = step_max
-
-        cur_formula = c_formula
-        prev_formula = cur_formula.copy()
-
-        prev_value, _ = self._zero_angles_function(prev_formula, target_angle_function)
-        cur_value, cur_details = self._zero_angles_function(cur_formula, target_angle_function)
-
-        is_success = self._is_success_step(cur_value, prev_value)
-        self.logger.log_iteration(cur_formula,
-                                  {'value': cur_value, 'success': True, 'step': step, 'details': cur_details})
-
-        i = 100
-        while (step > step_min or is_success) and i > 0:
-            i -= 1
-
-            old_prev_formula = prev_formula
-            prev_formula = cur_formula.copy()
-            gradient_value, gradient_details = self._zero_angles_gradient_function(cur_formula, target_angle_function)
-            cur_formula, by_planets = self._move_by_gradient(cur_formula, gradient_value, step, target_angle_function)
-
-            old_prev_value = prev_value
-            prev_value = cur_value
-            cur_value, cur_details = self._zero_angles_function(cur_formula, target_angle_function)
-
-            is_success = self._is_success_step(cur_value, prev_value)
-
-            self.logger.log_iteration(cur_formula,
-                                      {'value': cur_value, 'success': is_success, 'step': step,
-                                       'details': cur_details, 'gradient-details': gradient_details,
-                                       'by-planets': by_planets})
-
-            if not is_success:
-                if step > step_min:
-                    step /= 2
-
-                cur_formula = prev_formula
-                prev_formula = old_prev_formula
-
-                cur_value = prev_value
-                prev_value = old_prev_value
-
-        return cur_formula
-
-    @staticmethod
-    def _is_success_step(cur_value: float, prev_value: float):
-        return cur_value < prev_value and abs(cur_value - prev_value) > 0.00001
+    def _optimize_to_zero_angles(self, c_formula: CFormula, target_angle_function) -> (CFormula, OptimizationReport):
+        problem = _ZeroAnglesProblem(self, c_formula, target_angle_function)
+        x, report = self.optimizer.minimize(problem, problem.get_angles(c_formula))
+        problem.set_angles(c_formula, x)
+        return c_formula, report
 
     @staticmethod
     def _get_orbit_min_angle(c_formula: CFormula, orbit_num: int) -> float:
@@ -630,110 +721,6 @@ class AnglesLayoutMaker(LayoutMaker):
                 res += val2
         return res, planet_to_value
 
-    def _zero_angles_gradient_function(self, c_formula: CFormula, target_angle_function) -> (
-    [(str, float)], {str, (float, float, float, float, float, float)}):
-        planet_to_gradient_value = {}
-        target_angles = {}
-
-        planets_order = []
-        gradient_values = []
-
-        x0, y0 = c_formula.get_coordinates()
-
-        for orbit_num, planets in c_formula.soul_formula.orbits.items():
-            alpha_min = self._get_orbit_min_angle(c_formula, orbit_num)
-
-            cur_orbit_radius = c_formula.get_orbit_radius(orbit_num)
-            next_orbit_radius = c_formula.get_orbit_radius(orbit_num + 1)
-
-            for planet in planets:
-                res = 0
-                to_planet = c_formula.soul_formula.links[planet]
-
-                alpha0 = target_angle_function(c_formula, to_planet, orbit_num)
-                target_angles[planet] = alpha0
-
-                cur_alpha = c_formula.get_planet_angle(planet)
-                cur_cc = c_formula.get_planet_coordinates(planet)
-                # val1 = 2 * math.sin(cur_alpha - alpha0) * math.cos(cur_alpha - alpha0)
-                val1 = 2 * (cur_alpha - alpha0)
-                res += val1
-
-                val3 = 0
-
-                for next_planet in c_formula.soul_formula.reverse_links.get(planet, []):
-                    alpha_next = c_formula.get_planet_angle(next_planet)
-                    alpha_next0 = target_angle_function(c_formula, planet, orbit_num + 1)
-                    dd = (cur_orbit_radius / next_orbit_radius) * math.cos(cur_alpha) / math.sqrt(
-                        1 - (math.sin(cur_alpha) ** 2) * (cur_orbit_radius / next_orbit_radius) ** 2)
-                    if cur_cc.y > y0 and cur_cc.x >= x0:
-                        dd = -dd
-                    elif cur_cc.y >= y0 and cur_cc.x < x0:
-                        dd = -dd
-                    val3 += 2 * math.sin(alpha_next - alpha_next0) * math.cos(alpha_next - alpha_next0) * dd
-
-                res += val3
-
-                res1 = 0
-                for other_planet in planets:
-                    if planet == other_planet:
-                        continue
-                    other_planet_alpha = c_formula.get_planet_angle(other_planet)
-                    res1 += math.exp(-1000 * ((cur_alpha - other_planet_alpha) ** 2 - alpha_min ** 2)) \
-                            * (cur_alpha - other_planet_alpha)
-                val2 = res1 * (-1000) * 2
-                res += val2
-
-                planet_to_gradient_value[planet] = (val1, val2, val3, res)
-
-                planets_order.append(planet)
-                gradient_values.append(res)
-
-        gradient_len = math.sqrt(sum([a ** 2 for a in gradient_values]))
-        if gradient_len != 0:
-            gradient_values = [a / gradient_len for a in gradient_values]
-
-        zipped_result = []
-        for i in range(len(planets_order)):
-            zipped_result.append((planets_order[i], gradient_values[i]))
-        for planet, gradient_value in zipped_result:
-            val1, val2, val3, res = planet_to_gradient_value[planet]
-            target_angle = target_angles[planet]
-            planet_to_gradient_value[planet] = (target_angle, val1, val2, val3, res, gradient_value)
-
-        return zipped_result, planet_to_gradient_value
-
-    def _move_by_gradient(self, c_formula: CFormula, gradient_value: [(str, float)], step: float,
-                          target_angle_function) -> (CFormula, [str]):
-        start_formula = c_formula.copy()
-        start_value, _ = self._zero_angles_function(start_formula, target_angle_function)
-        for planet, gradient_val in gradient_value:
-            alpha = c_formula.get_planet_angle(planet)
-            alpha += step * -gradient_val
-            c_formula.set_planet_angle(planet, alpha)
-
-        cur_value, _ = self._zero_angles_function(c_formula, target_angle_function)
-        if self._is_success_step(cur_value, start_value):
-            return c_formula, []
-
-        if step > 10 * math.pi / 180:
-            return c_formula, []
-
-        success_planets = []
-        for planet, gradient_val in gradient_value:
-            source_alpha = start_formula.get_planet_angle(planet)
-            alpha = source_alpha + step * -gradient_val
-            start_formula.set_planet_angle(planet, alpha)
-
-            cur_value, _ = self._zero_angles_function(start_formula, target_angle_function)
-            if not self._is_success_step(cur_value, start_value):
-                start_formula.set_planet_angle(planet, source_alpha)
-            else:
-                success_planets.append(planet)
-        if len(success_planets) > 0:
-            return start_formula, success_planets
-        return c_formula, []
-
     def make_start_layout(self, formula: SoulFormula) -> CFormula:
         c_formula = CFormula(formula, AnglesLayoutMaker.planet_radius, AnglesLayoutMaker.orbit_width)
 
@@ -855,6 +842,91 @@ class AnglesLayoutMaker(LayoutMaker):
                 alpha += alpha_step
 
 
+def _make_candidate_layout(formula: SoulFormula, maker: AnglesLayoutMaker, cut_policy: CutPolicy) -> (
+        float, dict, OptimizationReport):
+    return maker.make_candidate_layout(formula, cut_policy)
+
+
+# _zero_angles_function как функция от вектора углов планет на орбитах (в порядке orbits) и её точный градиент;
+# центры неподвижны, поэтому цель планеты, которая ссылается на планету центра, считается один раз, а у планеты,
+# которая ссылается на планету предыдущей орбиты, цель — угол этой планеты (так её находит _get_alpha0_by_distance,
+# а sin² не меняется от сдвига цели на пи)
+class _ZeroAnglesProblem(AnglesProblem):
+
+    def __init__(self, maker: AnglesLayoutMaker, c_formula: CFormula, target_angle_function) -> None:
+        self.maker = maker
+        self.c_formula = c_formula
+        self.target_angle_function = target_angle_function
+
+        soul_formula = c_formula.soul_formula
+        self.planets = [planet for _, planets in soul_formula.orbits.items() for planet in planets]
+        planet_to_index = {planet: i for i, planet in enumerate(self.planets)}
+
+        self.target = np.zeros(len(self.planets))
+        self.target_index = np.full(len(self.planets), -1)
+        pairs_i, pairs_j, pairs_alpha_min = [], [], []
+        for orbit_num, planets in soul_formula.orbits.items():
+            alpha_min = maker._get_orbit_min_angle(c_formula, orbit_num)
+            for planet in planets:
+                i = planet_to_index[planet]
+                to_planet = soul_formula.links[planet]
+                if to_planet in planet_to_index:
+                    self.target_index[i] = planet_to_index[to_planet]
+                else:
+                    self.target[i] = target_angle_function(c_formula, to_planet, orbit_num)
+                for other_planet in planets:
+                    j = planet_to_index[other_planet]
+                    if i < j:
+                        pairs_i.append(i)
+                        pairs_j.append(j)
+                        pairs_alpha_min.append(alpha_min)
+        self.linked = self.target_index >= 0
+        self.pairs_i = np.array(pairs_i, dtype=np.intp)
+        self.pairs_j = np.array(pairs_j, dtype=np.intp)
+        self.pairs_alpha_min2 = np.array(pairs_alpha_min) ** 2
+
+    def get_angles(self, c_formula: CFormula) -> np.ndarray:
+        return np.array([c_formula.get_planet_angle(planet) for planet in self.planets], dtype=np.float64)
+
+    def set_angles(self, c_formula: CFormula, x: np.ndarray) -> None:
+        for planet, alpha in zip(self.planets, x.tolist()):
+            c_formula.set_planet_angle(planet, alpha)
+
+    def _get_diff(self, x: np.ndarray) -> np.ndarray:
+        target = self.target.copy()
+        target[self.linked] = x[self.target_index[self.linked]]
+        return x - target
+
+    def _get_pairs_penalty(self, x: np.ndarray) -> (np.ndarray, np.ndarray):
+        # каждая пара в _zero_angles_function учитывается дважды: от одной планеты и от другой
+        d = x[self.pairs_i] - x[self.pairs_j]
+        return d, np.exp(-1000 * (d * d - self.pairs_alpha_min2))
+
+    def value(self, x: np.ndarray) -> float:
+        _, penalty = self._get_pairs_penalty(x)
+        return float(np.sum(np.sin(self._get_diff(x)) ** 2) + 2 * np.sum(penalty))
+
+    def gradient(self, x: np.ndarray) -> np.ndarray:
+        val = np.sin(2 * self._get_diff(x))
+        res = val.copy()
+        np.add.at(res, self.target_index[self.linked], -val[self.linked])
+
+        d, penalty = self._get_pairs_penalty(x)
+        val = -4000 * penalty * d
+        np.add.at(res, self.pairs_i, val)
+        np.add.at(res, self.pairs_j, -val)
+        return res
+
+    def log_iteration(self, x: np.ndarray, value: float, success: bool, step: float) -> None:
+        if isinstance(self.maker.logger, NothingOptimizationLogger):
+            return
+        c_formula = self.c_formula.copy()
+        self.set_angles(c_formula, x)
+        _, details = self.maker._zero_angles_function(c_formula, self.target_angle_function)
+        self.maker.logger.log_iteration(c_formula, {'value': value, 'success': success, 'step': step,
+                                                    'details': details})
+
+
 def convert_cformula_to_dformula(c_formula: CFormula) -> DFormula:
     d_formula = DFormula(c_formula.soul_formula)
     centers = c_formula.get_centers()
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import partial
+from multiprocessing import Pool
+
+from model.sf import SoulFormula
+from model.sf_catalog import FormulaCatalog, get_catalog_file_name
+from view.sf_layout_angles import AnglesLayoutMaker, CutPolicy, CircleCutPolicy, RectangleCutPolicy
+
+LAYOUT_CACHE_FILE = 'cache/layout.sqlite'
+
+# меняется при любой правке алгоритма раскладки, чтобы не подхватывались записи, посчитанные по-старому
+LAYOUT_VERSION = 2
+
+
+# раскладки формул (снимки CFormula до обрезки) по ключу из структуры формулы и параметров раскладки:
+# в памяти процесса — всё, что уже запрашивалось, на диске в SQLite — общий для всех процессов набор
+class LayoutCache:
+
+    def __init__(self, file_name: str = LAYOUT_CACHE_FILE) -> None:
+        self.file_name = file_name
+        self.memory = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @staticmethod
+    def make_key(formula: SoulFormula, layout_params: tuple) -> str:
+        # дата, ретроградность и сила планет на раскладку не влияют; порядок планет в центрах и на орбитах
+        # берётся из множеств и зависит от PYTHONHASHSEED, поэтому ключ строится по каноническому виду:
+        # планеты орбит по порядку, каждый центр начинается с наименьшей планеты, центры — по (размеру, планетам)
+        centers = [center[center.index(min(center)):] + center[:center.index(min(center))]
+                   for center in formula.center]
+        structure = [sorted(formula.links.items()),
+                     sorted((tuple(center) for center in centers), key=lambda a: (len(a), a)),
+                     sorted((orbit_num, sorted(planets)) for orbit_num, planets in formula.orbits.items())]
+        return hashlib.sha256(json.dumps([LAYOUT_VERSION, structure, layout_params],
+                                         ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        # соединение своё у каждого потока и процесса: после fork унаследованное соединение использовать нельзя;
+        # файл создаётся при первом обращении, а не при импорте
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            dir_name = os.path.dirname(self.file_name)
+            if dir_name:
+                os.makedirs(dir_name, exist_ok=True)
+            connection = sqlite3.connect(self.file_name, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS layout (key TEXT PRIMARY KEY, layout TEXT)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get(self, key: str):
+        with self.lock:
+            layout = self.memory.get(key)
+        if layout is not None:
+            return layout
+        row = self._connect().execute('SELECT layout FROM layout WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        layout = json.loads(row[0])
+        with self.lock:
+            self.memory[key] = layout
+        return layout
+
+    def put(self, key: str, layout: dict) -> None:
+        self.put_many([(key, layout)])
+
+    def put_many(self, layouts: [(str, dict)]) -> None:
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO layout (key, layout) VALUES (?, ?)',
+                                   [(key, json.dumps(layout)) for key, layout in layouts])
+        with self.lock:
+            for key, layout in layouts:
+                self.memory[key] = layout
+
+    def contains(self, key: str) -> bool:
+        with self.lock:
+            if key in self.memory:
+                return True
+        return self._connect().execute('SELECT 1 FROM layout WHERE key = ?', (key,)).fetchone() is not None
+
+
+layout_cache = LayoutCache()
+
+
+def _make_layout(formula_with_key: (str, SoulFormula), cut_policy: CutPolicy) -> (str, dict):
+    key, formula = formula_with_key
+    return key, AnglesLayoutMaker().make_layout_data(formula, cut_policy)
+
+
+def warm_layout_cache(borders_file_name: str, cut_policies: [CutPolicy], cache: LayoutCache = layout_cache,
+                      processes=None, batch_size: int = 100) -> None:
+    # считает заранее раскладки всех различных по структуре формул из каталога, которых ещё нет в кэше
+    catalog = FormulaCatalog.load(get_catalog_file_name(borders_file_name))
+    for cut_policy in cut_policies:
+        layout_params = AnglesLayoutMaker().get_layout_params(cut_policy)
+        key_to_formula = {}
+        for formula in catalog.iterate_formulas():
+            key = cache.make_key(formula.formula, layout_params)
+            if key not in key_to_formula:
+                key_to_formula[key] = formula.formula
+        to_make = [(key, formula) for key, formula in key_to_formula.items() if not cache.contains(key)]
+        print(f'Раскладки {layout_params}: различных формул {len(key_to_formula)}, нужно посчитать {len(to_make)}')
+
+        with Pool(processes) as pool:
+            layouts = []
+            for i, key_with_layout in enumerate(pool.imap_unordered(partial(_make_layout, cut_policy=cut_policy),
+                                                                    to_make, chunksize=10)):
+                layouts.append(key_with_layout)
+                if len(layouts) >= batch_size:
+                    cache.put_many(layouts)
+                    layouts = []
+                    print(f'Посчитано раскладок: {i + 1} из {len(to_make)}')
+            cache.put_many(layouts)
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    # обрезка по кругу — карточки (OneCirclePrinter), по прямоугольнику — main_book и PDFPrinter по умолчанию
+    warm_layout_cache('data/borders_1900_2100.csv',
+                      [CircleCutPolicy(1.0), RectangleCutPolicy(100, 70), RectangleCutPolicy(97, 128)])
+    final_time_spend = time.time() - start_time
+    print(f'Кэш раскладок заполнен за {round(final_time_spend)} сек')
@@ -245,6 +245,250 @@ class GradientOptimization(Optimization):
         return planet_to_df
 
 
+# то же, что GradientOptimization (те же шаги, те же вызовы random и те же операции над float в том же порядке,
+# поэтому результат совпадает до бита), но положения планет лежат в списках по номерам, а не в словаре объектов,
+# пары планет для функции и градиента собраны заранее, и после неудачного шага градиент не пересчитывается
+class PackedGradientOptimization(Optimization):
+    z = 10
+
+    def optimize(self, d_formula: DFormula) -> None:
+        state = _OrbitPlanetsState(d_formula)
+        self.optimize_all(state)
+        self.optimize_by_one(state)
+        self.optimize_all(state)
+        state.save(d_formula)
+
+    def optimize_by_one(self, state) -> None:
+        orbit_planets = state.by_one_order
+        if len(orbit_planets) == 0:  # если нет планет на орбитах
+            return
+
+        old_function_value = self._optimization_function_value(state)
+        max_step_size = 2 * min(state.rs)
+        step_size = max_step_size
+
+        planet_to_optimize_idx = 0
+        df = None
+        while True:
+            # после неудачного шага планета возвращается на место, и градиент остаётся прежним
+            if df is None:
+                df = self._optimization_function_gradient_value(state)
+
+            k = orbit_planets[planet_to_optimize_idx]
+            planet = state.orbit_planets[k]
+            x0, y0, rw, rh = state.get_orbit(k)
+
+            pos = state.get_position(planet)
+            x, y = state.xs[planet], state.ys[planet]
+            prev_x = x
+            dy = df[k] * step_size
+            y -= dy
+            y = max(y0 - rh, y)
+            y = min(y0 + rh, y)
+            v = max(0, 1 - ((y - y0) ** 2) / (rh ** 2))
+            x = rw * math.sqrt(v)
+            if prev_x < x0:
+                x = -x
+            x += x0
+            state.move(planet, x, y)
+            new_function_value = self._optimization_function_value(state)
+
+            if new_function_value >= old_function_value \
+                    and planet_to_optimize_idx == len(orbit_planets) - 1 and step_size < 1:
+                state.set_position(planet, pos)
+                return
+            if new_function_value < old_function_value:
+                planet_to_optimize_idx = 0
+                old_function_value = new_function_value
+                step_size = max_step_size
+                df = None
+            elif step_size >= 1:
+                step_size /= 2
+                planet_to_optimize_idx = 0
+                state.set_position(planet, pos)
+            else:
+                state.set_position(planet, pos)
+                planet_to_optimize_idx += 1
+
+    def optimize_all(self, state) -> None:
+        old_function_value = self._optimization_function_value(state)
+        if old_function_value == 0:  # если нет планет на орбитах
+            return
+
+        max_step_size = 2 * min(state.rs)
+        step_size = max_step_size
+        df = None
+        while True:
+            if df is None:
+                df = self._optimization_function_gradient_value(state)
+            old_positions = state.get_positions()
+            for k, planet in enumerate(state.orbit_planets):
+                x0, y0, rw, rh = state.get_orbit(k)
+
+                x, y = state.xs[planet], state.ys[planet]
+                x_prev = x
+                r = state.rs[planet]
+                dy = df[k] * step_size
+                if dy == 0:
+                    to_planet = state.links[k]
+                    x_to, y_to = state.xs[to_planet], state.ys[to_planet]
+                    if abs(x - x0) < 0.001 and abs(x_to - x0) < 0.001:
+                        if random() >= 0.5:
+                            if y > y0:
+                                dy = r / 10
+                            else:
+                                dy = -r / 10
+
+                    elif abs(y - y0) < 0.001 and abs(y_to - y0) < 0.001:
+                        if random() >= 0.5:
+                            dy = r / 10
+                            if random() >= 0.5:
+                                dy *= -1
+
+                y -= dy
+                y = max(y0 - rh, y)
+                y = min(y0 + rh, y)
+                v = max(0, 1 - ((y - y0) ** 2) / (rh ** 2))
+
+                x = rw * math.sqrt(v)
+                if x_prev < x0:
+                    x = -x
+                elif x_prev == x0:
+                    if random() >= 0.5:
+                        x = -x
+                x += x0
+                state.move(planet, x, y)
+
+            new_function_value = self._optimization_function_value(state)
+            if new_function_value > old_function_value:
+                state.set_positions(old_positions)
+                if step_size <= 0.001:
+                    return
+                step_size /= 2
+            else:
+                old_function_value = new_function_value
+                if step_size < max_step_size:
+                    step_size *= 2
+                df = None
+
+    def _optimization_function_value(self, state) -> float:
+        # слагаемые в том же порядке, что и в GradientOptimization: ссылка планеты, затем её пары с остальными;
+        # numpy здесь не годится: его exp и возведение в квадрат иногда округляют иначе, чем math
+        xs, ys, rs = state.xs, state.ys, state.rs
+        value = 0
+        for planet_terms in state.terms:
+            for a, b, is_pair in planet_terms:
+                d = math.sqrt((xs[b] - xs[a]) ** 2 + (ys[b] - ys[a]) ** 2) - rs[a] * 1.15 - rs[b] * 1.15
+                value += math.exp(-self.z * d) if is_pair else d
+        return value
+
+    def _optimization_function_gradient_value(self, state) -> [float]:
+        xs, ys, rs = state.xs, state.ys, state.rs
+        z = self.z
+        planet_to_df = []
+        for k, planet_terms in enumerate(state.terms):
+            x0, y0, rw, rh = state.orbits[k]
+            value = 0
+            for a, b, is_pair in planet_terms:
+                x1, y1 = xs[a], ys[a]
+                x2, y2 = xs[b], ys[b]
+                d = math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+
+                # производная расстояния между планетами при движении первой из них по своей орбите
+                gradient = 0
+                sign = -1 if x1 < x0 else 1
+                v = 1 - ((y1 - y0) ** 2) / (rh ** 2)
+                if v > 0:
+                    dx1 = -rw * (y1 - y0) * sign / ((rh ** 2) * math.sqrt(v))
+                    gradient = - (y2 - y1 + (x2 - x1) * dx1) / d
+
+                if is_pair:
+                    value += math.exp(-z * (d - rs[a] * 1.15 - rs[b] * 1.15)) * (-z) * gradient
+                else:
+                    value = gradient
+            planet_to_df.append(value)
+        df_len = 0
+        for df in planet_to_df:
+            df_len += df ** 2
+        df_len = math.sqrt(df_len)
+        if df_len > 0:
+            planet_to_df = [df / df_len for df in planet_to_df]
+        return planet_to_df
+
+
+# положения планет формулы в списках по номерам, плюс заранее собранные индексы пар для функции и градиента
+class _OrbitPlanetsState:
+
+    def __init__(self, d_formula: DFormula) -> None:
+        self.positions = list(d_formula.planet_to_position.items())
+        planet_to_index = {planet: i for i, (planet, _) in enumerate(self.positions)}
+        self.start_positions = [pos for _, pos in self.positions]
+        self.cur_positions = list(self.start_positions)
+        self.xs = [pos.x for pos in self.start_positions]
+        self.ys = [pos.y for pos in self.start_positions]
+        self.rs = [pos.get_radius_device() for pos in self.start_positions]
+
+        # планеты на орбитах в порядке обхода orbit_to_position и параметры их орбит
+        self.orbit_planets, self.links, orbits = [], [], []
+        for orbit_num, orbit_pos in d_formula.orbit_to_position.items():
+            x0, y0 = orbit_pos.get_center_device()
+            orbit = (x0, y0, orbit_pos.get_w_radius_device(), orbit_pos.get_h_radius_device())
+            for planet in d_formula.formula.orbits[orbit_num]:
+                self.orbit_planets.append(planet_to_index[planet])
+                self.links.append(planet_to_index[d_formula.formula.links[planet]])
+                orbits.append(orbit)
+        self.orbits = orbits
+
+        # порядок обхода планет в optimize_by_one — по formula.orbits
+        orbit_planet_to_k = {planet: k for k, planet in enumerate(self.orbit_planets)}
+        self.by_one_order = [orbit_planet_to_k[planet_to_index[planet]]
+                             for _, planets in d_formula.formula.orbits.items() for planet in planets
+                             if planet_to_index[planet] in orbit_planet_to_k]
+
+        # слагаемые: для каждой планеты сначала ссылка, затем пары с планетами той же орбиты после неё;
+        # слагаемое — (планета, вторая планета, пара ли это)
+        self.terms = []
+        for orbit_num, orbit_pos in d_formula.orbit_to_position.items():
+            planets = d_formula.formula.orbits[orbit_num]
+            for i in range(len(planets)):
+                planet = planet_to_index[planets[i]]
+                link = planet_to_index[d_formula.formula.links[planets[i]]]
+                planet_terms = [(planet, link, False)]
+                for to_planet in planets[i + 1:]:
+                    planet_terms.append((planet, planet_to_index[to_planet], True))
+                self.terms.append(planet_terms)
+
+    def get_orbit(self, k: int) -> (float, float, float, float):
+        return self.orbits[k]
+
+    def get_position(self, planet: int):
+        return self.cur_positions[planet], self.xs[planet], self.ys[planet], self.rs[planet]
+
+    def set_position(self, planet: int, position) -> None:
+        self.cur_positions[planet], self.xs[planet], self.ys[planet], self.rs[planet] = position
+
+    def get_positions(self) -> list:
+        return [self.get_position(planet) for planet in self.orbit_planets]
+
+    def set_positions(self, positions: list) -> None:
+        for planet, position in zip(self.orbit_planets, positions):
+            self.set_position(planet, position)
+
+    def move(self, planet: int, x: float, y: float) -> None:
+        # как CirclePosition(x, y, r, 0) в GradientOptimization, вместе с его get_radius_device;
+        # сам объект создаётся только при сохранении
+        self.cur_positions[planet] = None
+        self.xs[planet], self.ys[planet] = x, y
+        self.rs[planet] = math.sqrt(self.rs[planet] ** 2 + 0 ** 2)
+
+    def save(self, d_formula: DFormula) -> None:
+        for i, (planet, _) in enumerate(self.positions):
+            if self.cur_positions[i] is None:
+                d_formula.set_planet_position(planet, CirclePosition(self.xs[i], self.ys[i], self.rs[i], 0))
+            else:
+                d_formula.set_planet_position(planet, self.cur_positions[i])
+
+
 class CornerOptimization(Optimization):
 
     def __init__(self) -> None:
@@ -308,4 +552,58 @@ class CornerOptimization(Optimization):
 
     def __get_gradient_distance_between_planets(self, orbit_num: int, planet1: str, planet2: str,
                                                 d_formula: DFormula) -> float:
-        pass
\ No newline at end of file
+        pass
+
+
+def _max_position_diff(d_formula1: DFormula, d_formula2: DFormula) -> float:
+    res = 0
+    for planet, pos1 in d_formula1.planet_to_position.items():
+        pos2 = d_formula2.get_planet_position(planet)
+        res = max(res, abs(pos1.x - pos2.x), abs(pos1.y - pos2.y))
+    return res
+
+
+if __name__ == '__main__':
+    import copy
+    import random as random_module
+    import time
+
+    from model.sf_catalog import FormulaCatalog, get_catalog_file_name
+    from view.sf_layout_angles import AnglesLayoutMaker, convert_cformula_to_dformula
+
+    # сравнение GradientOptimization и PackedGradientOptimization на разных по структуре формулах из каталога:
+    # стартовая раскладка та же, зерно random то же; печатаются время и наибольшее расхождение положений планет;
+    # каталог строится заранее (borders.make_catalog)
+    formulas_cnt = 50
+    catalog = FormulaCatalog.load(get_catalog_file_name('data/borders_1900_2100.csv'))
+    formulas = {}
+    for formula in catalog.iterate_formulas():
+        formulas.setdefault(formula.formula.get_key(), formula.formula)
+        if len(formulas) >= formulas_cnt:
+            break
+
+    layout_maker = AnglesLayoutMaker()
+    times = {'GradientOptimization': 0.0, 'PackedGradientOptimization': 0.0}
+    max_diff, diff_cnt, random_diff_cnt = 0.0, 0, 0
+    for i, formula in enumerate(formulas.values()):
+        start_layout = convert_cformula_to_dformula(
+            layout_maker.make_start_layout(layout_maker._generate_all_formulas(formula)[0]))
+        layouts, random_values = [], []
+        for optimization in [GradientOptimization(), PackedGradientOptimization()]:
+            d_formula = copy.deepcopy(start_layout)
+            random_module.seed(i)
+            start_time = time.time()
+            optimization.optimize(d_formula)
+            times[type(optimization).__name__] += time.time() - start_time
+            layouts.append(d_formula)
+            random_values.append(random())
+        diff = _max_position_diff(*layouts)
+        max_diff = max(max_diff, diff)
+        diff_cnt += diff > 0
+        random_diff_cnt += random_values[0] != random_values[1]
+
+    for name, time_spend in times.items():
+        print(f'{name}: {round(time_spend, 1)} сек на {len(formulas)} формул')
+    print(f'Ускорение: {round(times["GradientOptimization"] / times["PackedGradientOptimization"], 1)} раз')
+    print(f'Формул с отличиями: {diff_cnt}, наибольшее отличие: {max_diff} px, '
+          f'разошлась последовательность random: {random_diff_cnt}')
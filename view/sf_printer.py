@@ -12,8 +12,9 @@ from model.sf import SoulFormulaWithBorders, Cosmogram, NumericInfo
 from view.sf_cairo import SimpleFormulaDrawer, DFormula, CirclePosition, OrbitPosition, DrawProfile
 from view.sf_cosmogram import DefaultCosmogramDrawer
 from view.sf_geometry import rotate_point
-from view.sf_layout import DefaultLayoutMaker, RectangleFormulaCutter, CircleFormulaCutter
-from view.sf_layout_angles import AnglesLayoutMaker, CircleCutPolicy
+from view.sf_layout import DefaultLayoutMaker, CircleFormulaCutter
+from view.sf_layout_angles import AnglesLayoutMaker, CircleCutPolicy, RectangleCutPolicy
+from view.sf_layout_cache import layout_cache
 from view.sf_numeric import NumericDrawer
 
 
@@ -66,7 +67,8 @@ class PDFPrinter(SoulFormulaPrinter):
         formula_height = int((self.height - 2 * self.border_offset - self.cols * (
                 self.cell_offset + self.formula_title_height) - self.title_height) / self.cols)
 
-        layout_maker = DefaultLayoutMaker(RectangleFormulaCutter(formula_width, formula_height))
+        layout_maker = AnglesLayoutMaker(layout_cache=layout_cache)
+        cut_policy = RectangleCutPolicy(formula_width, formula_height)
         drawer = SimpleFormulaDrawer()
 
         surface_pdf = cairo.PDFSurface(self.out_path, self.width, self.height)
@@ -107,7 +109,7 @@ class PDFPrinter(SoulFormulaPrinter):
             cr.scale(formula_width, formula_width)
             start_time = time.time()
             print(f'Начинаю рендеринг формулы {formula.formula}...')
-            d_formula = layout_maker.make_layout(formula.formula)
+            d_formula = layout_maker.make_layout(formula.formula, formula_width, formula_height, cut_policy=cut_policy)
             final_time_spend = time.time() - start_time
             print(f'Рендеринг завершён за {round(final_time_spend)} сек ({round(final_time_spend / 60.0, 1)} мин)')
             drawer.draw_formula(d_formula, cr)
@@ -523,7 +525,7 @@ class OneCirclePrinter:
 
         formula_radius = self.circle_radius * 0.65
         # layout_maker = DefaultLayoutMaker(CircleFormulaCutter(formula_radius))
-        layout_maker = AnglesLayoutMaker()
+        layout_maker = AnglesLayoutMaker(layout_cache=layout_cache)
         drawer = SimpleFormulaDrawer()
 
         cr = cairo.Context(surface.create_for_rectangle(